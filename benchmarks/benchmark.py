@@ -0,0 +1,204 @@
+import argparse
+import json
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import falcon
+
+import query_weight.query_algorithms as qa
+from benchmarks.synthetic_graph import (generate_graph, get_accessions,
+                                        save_graph)
+from graph_utils import get_pdb_path, load_compact_graph
+from path_to_output import PathToFasta
+from query_weight.exact_index import build_exact_index, get_integer_resolution
+from query_weight.k_tuner import sample_peptide_weights, tune_k
+from query_weight.mono_weight_query import ALGORITHMS, get_query_interval
+
+# The weight factor of the graphs (the masses are multiplied by it)
+WEIGHT_FACTOR = 1000000000
+
+
+def measure(func, repeat):
+    """
+    Measures the best time (in seconds) of repeat many calls of func and the peak memory (in bytes, via tracemalloc)
+    of an additional call. Returns the time, the peak memory and the result of the last call.
+    """
+    times = []
+    for _ in range(repeat):
+        starttime = timeit.default_timer()
+        result = func()
+        times.append(timeit.default_timer() - starttime)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak, result
+
+
+def benchmark_protein(base_dir, accession, args):
+    """
+    Benchmark the building of the pdbs (and the exact index), all query algorithms and path_to_fasta
+    on a (saved) protein
+    """
+    results = []
+
+    def _report(name, time, peak, **info):
+        results.append(dict(accession=accession, name=name, time=time, peak_memory=peak, **info))
+        print(
+            "{:<10} {:<28} {:>12.2f} ms {:>12.1f} KiB {}".format(
+                accession, name, time * 1000, peak / 1024, " ".join("{}={}".format(*x) for x in info.items())
+            ),
+            flush=True
+        )
+
+    graph = load_compact_graph(base_dir, accession)
+    print("{}: {} nodes, {} edges".format(accession, graph.vcount, graph.ecount), flush=True)
+
+    time, peak, _ = measure(lambda: qa.build_top_sort_attrs(graph), args.repeat)
+    _report("build_top_sort_attrs", time, peak)
+    for k in args.k:
+        time, peak, _ = measure(lambda: qa.build_pdb(graph, k=k), args.repeat)
+        _report("build_pdb", time, peak, k=k)
+    time, peak, exact_index = measure(
+        lambda: build_exact_index(graph, *get_integer_resolution(WEIGHT_FACTOR, args.resolution)), args.repeat
+    )
+    _report("build_exact_index", time, peak, resolution=args.resolution, intervals=len(exact_index.lows))
+
+    # Tuning of k (work of the sampled queries per k)
+    time, peak, (tuned_k, work, _) = measure(lambda: tune_k(graph), 1)
+    _report("tune_k", time, peak, k=tuned_k, work=work)
+
+    # Queries (around the weights of sampled peptides). top_sort_exact prunes via the exact index
+    n_pdb = get_pdb_path(base_dir, accession, graph, args.query_k)
+    methods = dict(ALGORITHMS, count=qa.count_query, top_sort_exact=qa.top_sort_query)
+    names = args.algorithms if args.algorithms else list(methods)
+    found_paths = []
+    for q_idx, weight in enumerate(sample_peptide_weights(graph, args.queries, args.seed)):
+        q_interval = get_query_interval(WEIGHT_FACTOR, weight / WEIGHT_FACTOR, args.tolerance, args.unit)
+        for name in names:
+            deadlines, stats = [], []
+
+            def _query():
+                deadlines.append(qa.Deadline(args.timeout))
+                stats.append(qa.SearchStats())
+                return methods[name](
+                    graph.start, graph.end, q_interval, graph, exact_index if name == "top_sort_exact" else n_pdb,
+                    _deadline=deadlines[-1], _stats=stats[-1]
+                )
+
+            time, peak, result = measure(_query, args.repeat)
+            num_results = result if name == "count" else len(result[0])
+            _report(
+                name, time, peak, query=q_idx, results=num_results, expired=any(d.expired for d in deadlines),
+                **stats[-1].as_dict()
+            )
+            if name == "top_sort" and len(found_paths) < args.max_paths:
+                found_paths.extend(result[0][:args.max_paths - len(found_paths)])
+
+    # The path_to_fasta pipeline (checks, peptides and headers, FASTA serialization) on the found paths
+    path_to_fasta = PathToFasta(base_dir)
+
+    def _to_fasta():
+        resp = falcon.Response()
+        peptides = path_to_fasta._get_peptides(resp, accession, found_paths)
+        path_to_fasta._return_content(resp, peptides, as_json=False)
+        return resp.body
+
+    time, peak, _ = measure(_to_fasta, args.repeat)
+    _report("path_to_fasta", time, peak, paths=len(found_paths))
+
+    return results
+
+
+def parse_args():
+    # Arguments for Parser
+    parser = argparse.ArgumentParser(
+        description="Benchmark the query algorithms, the building of the pdbs and path_to_fasta on "
+        "synthetic (deterministic) protein graphs. Times are the best of all repetitions, the peak memory "
+        "is measured (via tracemalloc) in an additional run."
+    )
+    parser.add_argument(
+        "--lengths", "-len", type=int, nargs="+", default=[200, 500, 1000],
+        help="The lengths of the (canonical) sequences of the proteins, one protein per length. "
+        "Default is set to 200, 500 and 1000."
+    )
+    parser.add_argument(
+        "--variants", "-v", type=float, default=0.05,
+        help="The number of variants per residue. Default is set to 0.05."
+    )
+    parser.add_argument(
+        "--isoforms", "-i", type=int, default=1,
+        help="The number of isoforms per protein. Default is set to 1."
+    )
+    parser.add_argument(
+        "--seed", "-s", type=int, default=0,
+        help="The seed of the generator and the sampled queries. Default is set to 0."
+    )
+    parser.add_argument(
+        "--k", "-k", type=int, nargs="+", default=[5, 10, 20],
+        help="The numbers of intervals, for which the pdb is built. Default is set to 5, 10 and 20."
+    )
+    parser.add_argument(
+        "--query_k", "-qk", type=int, default=10,
+        help="The number of intervals of the pdb used by the queries. Default is set to 10."
+    )
+    parser.add_argument(
+        "--resolution", "-res", type=float, default=0.01,
+        help="The resolution (in Da) of the exact index. Default is set to 0.01."
+    )
+    parser.add_argument(
+        "--algorithms", "-a", type=str, nargs="+", choices=[*ALGORITHMS, "count", "top_sort_exact"], default=None,
+        help="The algorithms, which are benchmarked. Default are all."
+    )
+    parser.add_argument(
+        "--queries", "-q", type=int, default=3,
+        help="The number of queries per protein (around the weights of sampled peptides). Default is set to 3."
+    )
+    parser.add_argument(
+        "--tolerance", "-t", type=float, default=10,
+        help="The mass tolerance of the queries. Default is set to 10."
+    )
+    parser.add_argument(
+        "--unit", "-u", type=str, default="ppm", choices=["ppm", "Da"],
+        help="The unit of the mass tolerance. Default is set to 'ppm'."
+    )
+    parser.add_argument(
+        "--timeout", "-to", type=float, default=60,
+        help="The timeout of a query (in seconds). Default is set to 60."
+    )
+    parser.add_argument(
+        "--repeat", "-r", type=int, default=3,
+        help="The number of repetitions of each measurement. Default is set to 3."
+    )
+    parser.add_argument(
+        "--max_paths", "-mp", type=int, default=1000,
+        help="The maximum number of (found) paths, which are converted via path_to_fasta. Default is set to 1000."
+    )
+    parser.add_argument(
+        "--output", "-o", type=str, default=None,
+        help="Write the results additionally as json into this file."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as base_dir:
+        for accession, length in zip(get_accessions(len(args.lengths)), args.lengths):
+            save_graph(
+                base_dir, accession,
+                generate_graph(accession, length, round(args.variants * length), args.isoforms, args.seed)
+            )
+            results.extend(benchmark_protein(base_dir, accession, args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=4)
+    print("Benchmarked {} proteins".format(len(args.lengths)), file=sys.stderr)
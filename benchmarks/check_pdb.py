@@ -0,0 +1,156 @@
+import argparse
+import sys
+import tempfile
+
+import numpy as np
+
+import query_weight.query_algorithms as qa
+from benchmarks.synthetic_graph import (generate_graph, get_accessions,
+                                        save_graph)
+from graph_utils import load_compact_graph
+from query_weight.k_tuner import sample_peptide_weights
+from query_weight.mono_weight_query import ALGORITHMS, get_query_interval
+
+# The weight factor of the graphs (the masses are multiplied by it)
+WEIGHT_FACTOR = 1000000000
+
+
+def build_reference_intervals(order, offsets, neighbors, weights, vcount, k):
+    """
+    Reference (node by node) implementation of the pdb builder, as it was before it was vectorized: The shifted
+    intervals of the neighbors are sorted, overlapping ones are merged and then the closest ones, until at most k
+    are left. Returns the intervals of all nodes as matrix (shape: n x k x 2, filled with nans).
+    """
+    offsets, neighbors, weights = offsets.tolist(), neighbors.tolist(), weights.tolist()
+    pdb = [[] for _ in range(vcount)]
+    pdb[order[0]] = [[0, 0]]
+    for node in order[1:]:
+        intervals = []
+        for edge in range(offsets[node], offsets[node + 1]):
+            intervals.extend([x + weights[edge], y + weights[edge]] for x, y in pdb[neighbors[edge]])
+        if len(intervals) == 0:
+            # Not reachable
+            continue
+
+        intervals = qa._merge_overlapping_intervals(sorted(intervals, key=lambda x: x[0]))
+        while len(intervals) > k:
+            diff = [y[0] - x[1] for x, y in zip(intervals, intervals[1:])]
+            argmin = diff.index(min(diff))
+            intervals = intervals[:argmin] + [[intervals[argmin][0], intervals[argmin + 1][1]]] + intervals[argmin + 2:]
+        pdb[node] = intervals
+
+    matrix = np.full((vcount, k, 2), np.nan)
+    for node, intervals in enumerate(pdb):
+        if len(intervals) != 0:
+            matrix[node, :len(intervals)] = intervals
+    return matrix
+
+
+def build_reference_pdb(graph, k=5):
+    """ Reference pdb (see build_reference_intervals) """
+    return build_reference_intervals(
+        graph.top_sort[::-1].tolist(), graph.out_offsets, graph.out_targets, graph.out_weights, graph.vcount, k
+    )
+
+
+def build_reference_forward_pdb(graph, k=5):
+    """ Reference forward pdb (see build_reference_intervals) """
+    in_offsets, in_sources, in_weights = qa._get_in_edges(graph)
+    return build_reference_intervals(graph.top_sort.tolist(), in_offsets, in_sources, in_weights, graph.vcount, k)
+
+
+def _path_set(result):
+    """ The found paths and their weights of a query as a set """
+    paths, weights = result
+    return set(zip(map(tuple, map(list, paths)), map(int, weights)))
+
+
+def check_protein(base_dir, accession, args):
+    """
+    Checks on a (saved) protein, that the pdbs equal the reference pdbs (for each k) and that all query algorithms
+    find the same paths as top_sort on the reference pdb. Returns the list of failed checks.
+    """
+    graph = load_compact_graph(base_dir, accession)
+    print("{}: {} nodes, {} edges".format(accession, graph.vcount, graph.ecount), flush=True)
+
+    failed = []
+    for k in args.k:
+        for name, build, reference in [
+            ("build_pdb", qa.build_pdb, build_reference_pdb),
+            ("build_forward_pdb", qa.build_forward_pdb, build_reference_forward_pdb)
+        ]:
+            if not np.array_equal(build(graph, k=k), reference(graph, k=k), equal_nan=True):
+                failed.append("{} {} k={}".format(accession, name, k))
+
+    n_pdb, reference_pdb = qa.build_pdb(graph, k=args.query_k), build_reference_pdb(graph, k=args.query_k)
+    for q_idx, weight in enumerate(sample_peptide_weights(graph, args.queries, args.seed)):
+        q_interval = get_query_interval(WEIGHT_FACTOR, weight / WEIGHT_FACTOR, args.tolerance, args.unit)
+        expected = _path_set(qa.top_sort_query(graph.start, graph.end, q_interval, graph, reference_pdb))
+        for name, method in ALGORITHMS.items():
+            if _path_set(method(graph.start, graph.end, q_interval, graph, n_pdb)) != expected:
+                failed.append("{} {} query={}".format(accession, name, q_idx))
+    return failed
+
+
+def parse_args():
+    # Arguments for Parser
+    parser = argparse.ArgumentParser(
+        description="Check the (vectorized) building of the pdbs against a reference (node by node) implementation "
+        "and the paths found by all query algorithms against top_sort on synthetic (deterministic) protein graphs."
+    )
+    parser.add_argument(
+        "--lengths", "-len", type=int, nargs="+", default=[200, 500, 1000],
+        help="The lengths of the (canonical) sequences of the proteins, one protein per length. "
+        "Default is set to 200, 500 and 1000."
+    )
+    parser.add_argument(
+        "--variants", "-v", type=float, default=0.05,
+        help="The number of variants per residue. Default is set to 0.05."
+    )
+    parser.add_argument(
+        "--isoforms", "-i", type=int, default=1,
+        help="The number of isoforms per protein. Default is set to 1."
+    )
+    parser.add_argument(
+        "--seed", "-s", type=int, default=0,
+        help="The seed of the generator and the sampled queries. Default is set to 0."
+    )
+    parser.add_argument(
+        "--k", "-k", type=int, nargs="+", default=[1, 2, 5, 10, 20],
+        help="The numbers of intervals, for which the pdbs are checked. Default is set to 1, 2, 5, 10 and 20."
+    )
+    parser.add_argument(
+        "--query_k", "-qk", type=int, default=10,
+        help="The number of intervals of the pdb used by the queries. Default is set to 10."
+    )
+    parser.add_argument(
+        "--queries", "-q", type=int, default=3,
+        help="The number of queries per protein (around the weights of sampled peptides). Default is set to 3."
+    )
+    parser.add_argument(
+        "--tolerance", "-t", type=float, default=10,
+        help="The mass tolerance of the queries. Default is set to 10."
+    )
+    parser.add_argument(
+        "--unit", "-u", type=str, default="ppm", choices=["ppm", "Da"],
+        help="The unit of the mass tolerance. Default is set to 'ppm'."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    failed = []
+    with tempfile.TemporaryDirectory() as base_dir:
+        for accession, length in zip(get_accessions(len(args.lengths)), args.lengths):
+            save_graph(
+                base_dir, accession,
+                generate_graph(accession, length, round(args.variants * length), args.isoforms, args.seed)
+            )
+            failed.extend(check_protein(base_dir, accession, args))
+
+    for check in failed:
+        print("Failed: {}".format(check), file=sys.stderr)
+    print("{} checks failed".format(len(failed)) if failed else "All checks passed", file=sys.stderr)
+    sys.exit(1 if failed else 0)
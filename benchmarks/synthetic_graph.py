@@ -0,0 +1,169 @@
+import argparse
+import os
+import pickle
+import random
+
+import igraph
+from Bio.SeqFeature import FeatureLocation
+from Bio.SwissProt import FeatureTable
+from protgraph.aa_masses_annotation import _get_mass_dict
+
+from graph_utils import get_protein_file, set_layout
+
+# The aminoacids and their (approximate) frequencies in UniProtKB/Swiss-Prot (in percent)
+AMINOACIDS = "ARNDCQEGHILKMFPSTWYV"
+FREQUENCIES = [8.3, 5.5, 4.1, 5.5, 1.4, 3.9, 6.7, 7.1, 2.3, 5.9, 9.7, 5.8, 2.4, 3.9, 4.7, 6.6, 5.4, 1.1, 2.9, 6.9]
+
+MASS_DICT = _get_mass_dict(factor=1000000000)
+
+
+def generate_graph(accession, length, variants=0, isoforms=0, seed=0):
+    """
+    Generates a (deterministic) protein graph similar to the ones exported by ProtGraph (not collapsed):
+    The canonical sequence and the isoforms (the canonical sequence with a replaced segment) are chains
+    from __start__ to __end__. Variants add substituted nodes (with VARIANT qualifiers on their in-edges)
+    at the same positions in each chain and the graph is digested by trypsin (after K/R, not before P),
+    so that missed cleavages are marked via the attribute cleaved.
+    """
+    rng = random.Random("{}:{}".format(accession, seed))
+    sequence = "".join(rng.choices(AMINOACIDS, weights=FREQUENCIES, k=length))
+
+    # Attributes of the nodes
+    v_attrs = dict(aminoacid=[], position=[], accession=[], isoform_position=[], isoform_accession=[])
+
+    def _add_node(aminoacid, position, isoform_position=None, isoform_accession=None):
+        v_attrs["aminoacid"].append(aminoacid)
+        v_attrs["position"].append(position)
+        v_attrs["accession"].append(accession)
+        v_attrs["isoform_position"].append(isoform_position)
+        v_attrs["isoform_accession"].append(isoform_accession)
+        return len(v_attrs["aminoacid"]) - 1
+
+    start = _add_node("__start__", 0)
+    end = _add_node("__end__", length + 1)
+
+    # The chains: Lists of (aminoacid, canonical position) of the canonical sequence and each isoform
+    chains = [(None, [(aa, pos) for pos, aa in enumerate(sequence, start=1)])]
+    for iso in range(isoforms):
+        seg_start = rng.randrange(length)
+        seg_end = min(length, seg_start + rng.randint(1, 30))
+        replacement = rng.choices(AMINOACIDS, weights=FREQUENCIES, k=rng.randint(0, 30))
+        chains.append((
+            "{}-{}".format(accession, iso + 2),
+            chains[0][1][:seg_start] + [(aa, None) for aa in replacement] + chains[0][1][seg_end:]
+        ))
+
+    # The variants (by canonical position)
+    features = dict()
+    for var_id, pos in enumerate(sorted(rng.sample(range(1, length + 1), min(variants, length))), start=1):
+        ref = sequence[pos - 1]
+        alt = rng.choice(AMINOACIDS.replace(ref, ""))
+        features[pos] = FeatureTable(
+            location=FeatureLocation(pos - 1, pos), type="VARIANT", id="VAR_{}{:03d}".format(accession, var_id),
+            qualifiers={"note": "{} -> {}".format(ref, alt)}
+        )
+
+    # Build each chain: Every node (and its variants) is connected to all alternatives of the next position
+    variant_features = dict()  # node -> feature
+    edges = set()
+    for isoform_accession, residues in chains:
+        alternatives = [[start]]
+        for iso_pos, (aa, pos) in enumerate(residues, start=1):
+            alternatives.append([_add_node(
+                aa, pos, iso_pos if isoform_accession else None, isoform_accession
+            )])
+            if pos in features:
+                var_node = _add_node(features[pos].qualifiers["note"][-1], None, None, isoform_accession)
+                variant_features[var_node] = features[pos]
+                alternatives[-1].append(var_node)
+        alternatives.append([end])
+        edges.update((s, t) for prev, cur in zip(alternatives, alternatives[1:]) for s in prev for t in cur)
+
+    # Digest (trypsin): Edges between cleavage sites are missed cleavages, add the edges from start and to end
+    aminoacids = v_attrs["aminoacid"]
+    cleaved = set()
+    for s, t in sorted(edges):
+        if s != start and t != end and aminoacids[s] in "KR" and aminoacids[t] != "P":
+            cleaved.add((s, t))
+    for s, t in sorted(cleaved):
+        edges.add((start, t))
+        edges.add((s, end))
+
+    # Set the edge attributes (qualifiers, cleaved and the mono weight of the target)
+    edges = sorted(edges)
+    e_attrs = dict(qualifiers=[], cleaved=[], mono_weight=[])
+    for s, t in edges:
+        if t in variant_features:
+            e_attrs["qualifiers"].append([variant_features[t]])
+        elif s in variant_features:
+            e_attrs["qualifiers"].append([])
+        else:
+            e_attrs["qualifiers"].append(None)
+        e_attrs["cleaved"].append(True if (s, t) in cleaved else None)
+        e_attrs["mono_weight"].append(0 if t == end else MASS_DICT[aminoacids[t]][0])
+
+    v_attrs["mono_weight"] = [MASS_DICT[aa][0] if aa in MASS_DICT else 0 for aa in aminoacids]
+    return igraph.Graph(
+        n=len(aminoacids), edges=edges, directed=True, vertex_attrs=v_attrs, edge_attrs=e_attrs
+    )
+
+
+def get_accessions(num_proteins, offset=0):
+    """ Returns the accessions of the synthetic proteins """
+    return ["SYN{:05d}".format(i) for i in range(offset, offset + num_proteins)]
+
+
+def save_graph(base_dir, accession, graph):
+    """ Save a graph (pickled, like the exports of ProtGraph) into the base folder (depending on the layout) """
+    path = get_protein_file(base_dir, accession, ".pickle")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump(graph, f)
+
+
+def parse_args():
+    # Arguments for Parser
+    parser = argparse.ArgumentParser(
+        description="Generate a base folder with synthetic (deterministic) protein graphs, "
+        "which are similar to the ones exported by ProtGraph"
+    )
+    parser.add_argument(
+        "base_folder", type=str,
+        help="The base folder, in which the graphs are saved."
+    )
+    parser.add_argument(
+        "--layout", "-l", type=str, default="nested", choices=["nested", "flat"],
+        help="The layout of the base folder: 'nested' (like graphs exported with '-edirs') or 'flat'. "
+        "Default is 'nested'."
+    )
+    parser.add_argument(
+        "--num_proteins", "-n", type=int, default=100,
+        help="The number of proteins. Default is set to 100."
+    )
+    parser.add_argument(
+        "--length", "-len", type=int, default=400,
+        help="The length of the (canonical) sequences. Default is set to 400."
+    )
+    parser.add_argument(
+        "--variants", "-v", type=int, default=20,
+        help="The number of variants per protein. Default is set to 20."
+    )
+    parser.add_argument(
+        "--isoforms", "-i", type=int, default=1,
+        help="The number of isoforms per protein. Default is set to 1."
+    )
+    parser.add_argument(
+        "--seed", "-s", type=int, default=0,
+        help="The seed of the generator. Default is set to 0."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_layout(args.layout)
+    for acc in get_accessions(args.num_proteins):
+        save_graph(
+            args.base_folder, acc, generate_graph(acc, args.length, args.variants, args.isoforms, args.seed)
+        )
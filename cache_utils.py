@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU-cache with a memory budget (in bytes). Entries are validated against the
+    modification time and size of the file they were loaded from, so changed files are reloaded.
+    If ttl (in seconds) is set, entries expire after this time.
+    """
+
+    def __init__(self, max_bytes=0, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (stamp, value, size, time of insertion)
+        self._lock = threading.Lock()
+        self._loading = dict()  # key -> lock, so that the same entry is only loaded once
+
+    def resize(self, max_bytes):
+        """ Set a new memory budget, evicting entries if necessary """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def set_ttl(self, ttl):
+        """ Set the time to live (in seconds) of entries (None for no expiration) """
+        with self._lock:
+            self.ttl = ttl
+
+    def clear(self):
+        """ Remove all entries from the cache """
+        with self._lock:
+            self._entries.clear()
+            self.cur_bytes = 0
+
+    def stats(self):
+        """ Returns the counters of this cache """
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+                hit_rate=self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+                entries=len(self._entries),
+                bytes=self.cur_bytes,
+                max_bytes=self.max_bytes
+            )
+
+    def get(self, key, path, loader, size=None, cache_if=None):
+        """
+        Returns the cached value for key. If it is not present (or the file at path has changed),
+        loader(path) is called and its result is cached (only if cache_if(value), if given).
+        The size of an entry is given by size(value) or defaults to the size of the file on disk.
+        """
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            value = self._lookup(key, stamp)
+            if value is not None:
+                return value
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another thread may have loaded it in the meantime
+            with self._lock:
+                value = self._lookup(key, stamp)
+                if value is not None:
+                    return value
+                self.misses += 1
+
+            try:
+                value = loader(path)
+                entry_size = size(value) if size is not None else st.st_size
+
+                with self._lock:
+                    if entry_size <= self.max_bytes and (cache_if is None or cache_if(value)):
+                        self._remove(key)
+                        self._entries[key] = (stamp, value, entry_size, time.monotonic())
+                        self.cur_bytes += entry_size
+                        self._evict()
+            finally:
+                # Also if the loader raised, so that no lock is left behind per failing key
+                with self._lock:
+                    self._loading.pop(key, None)
+
+        return value
+
+    def _lookup(self, key, stamp):
+        """ Lookup an entry (lock needs to be held). Returns None if missing or outdated """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != stamp:
+            return None
+        if self.ttl is not None and time.monotonic() - entry[3] > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def _remove(self, key):
+        """ Remove an entry (lock needs to be held) """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.cur_bytes -= entry[2]
+
+    def _evict(self):
+        """ Evict least recently used entries until we are in budget (lock needs to be held) """
+        while self.cur_bytes > self.max_bytes and self._entries:
+            _, (_, _, entry_size, _) = self._entries.popitem(last=False)
+            self.cur_bytes -= entry_size
+            self.evictions += 1
+
+
+# The graph cache, which is shared across all worker threads (configured in main.py)
+GRAPH_CACHE = LRUCache(max_bytes=1024 * 1024 * 1024)
+
+# The cache of the metadata of base folders (indices of the archive, pdb stores and mass index, tuned ks, ...),
+# kept apart from the graph cache, so that its budget and hit rate only cover the graphs (configured in main.py)
+METADATA_CACHE = LRUCache(max_bytes=256 * 1024 * 1024)
+
+# The cache of (complete) weight query results, validated against the graph file (configured in main.py)
+RESULT_CACHE = LRUCache(max_bytes=256 * 1024 * 1024, ttl=3600)
@@ -0,0 +1,92 @@
+import glob
+import mmap
+import os
+import pickle
+import time
+
+import numpy as np
+
+from cache_utils import METADATA_CACHE
+
+ARCHIVE_INDEX_FILE = "graphs.pack.npz"
+
+
+class GraphArchive(object):
+    """
+    Packed archive of the pickled graphs of all proteins: a single data file, which contains the
+    pickled graphs one after another, and an index of the sorted accessions with their offsets and lengths.
+    The data file is memory mapped, so reading a graph needs no additional open/stat calls.
+    """
+
+    def __init__(self, accessions, offsets, lengths, data_path):
+        self.accessions = accessions  # sorted
+        self.offsets = offsets
+        self.lengths = lengths
+        self.data_path = data_path
+        with open(data_path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(data_path) else b""
+
+    @property
+    def nbytes(self):
+        """ The (estimated) memory consumption in bytes (the memory mapped data is not counted) """
+        return self.accessions.nbytes + self.offsets.nbytes + self.lengths.nbytes
+
+    def _index(self, accession):
+        """ The index of accession or None, if it is not in the archive """
+        idx = np.searchsorted(self.accessions, accession)
+        if idx == len(self.accessions) or self.accessions[idx] != accession:
+            return None
+        return idx
+
+    def __contains__(self, accession):
+        return self._index(accession) is not None
+
+    def read(self, accession):
+        """ Read (unpickle) the graph of accession """
+        idx = self._index(accession)
+        return pickle.loads(self.data[self.offsets[idx]:self.offsets[idx] + self.lengths[idx]])
+
+
+def save_graph_archive(base_dir, accessions, graph_paths):
+    """
+    Pack the pickled graphs (at graph_paths) of the accessions into an archive. A new data file is written first,
+    then the index pointing to it is replaced atomically, so running servers never see a partial archive.
+    Old data files are removed afterwards.
+    """
+    order = np.argsort(np.array(accessions, dtype=str), kind="stable")
+    accessions = np.array(accessions, dtype=str)[order]
+
+    # Copy the pickled graphs into the data file
+    data_file = "graphs.{}.pack".format(time.time_ns())
+    lengths = np.zeros(len(accessions), dtype=np.int64)
+    with open(os.path.join(base_dir, data_file), "wb") as out:
+        for idx, graph_idx in enumerate(order):
+            with open(graph_paths[graph_idx], "rb") as f:
+                lengths[idx] = out.write(f.read())
+    offsets = np.cumsum(lengths) - lengths
+
+    # Replace the index (graph_utils imports this module, so it is imported here)
+    from graph_utils import save_atomically
+    save_atomically(
+        os.path.join(base_dir, ARCHIVE_INDEX_FILE),
+        lambda f: np.savez(f, accessions=accessions, offsets=offsets, lengths=lengths, data_file=data_file)
+    )
+
+    for old_file in glob.glob(os.path.join(base_dir, "graphs.*.pack")):
+        if os.path.basename(old_file) != data_file:
+            os.remove(old_file)
+
+
+def load_graph_archive(base_dir):
+    """ Load the archive of base_dir (kept in the cache). Returns None, if it was not built """
+    path = os.path.join(base_dir, ARCHIVE_INDEX_FILE)
+    if not os.path.isfile(path):
+        return None
+
+    def _load(path):
+        with np.load(path) as npz:
+            return GraphArchive(
+                npz["accessions"], npz["offsets"], npz["lengths"], os.path.join(base_dir, str(npz["data_file"]))
+            )
+
+    return METADATA_CACHE.get(("archive", base_dir), path, _load, size=lambda archive: archive.nbytes)
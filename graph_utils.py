@@ -1,75 +1,190 @@
 import json
 import os
+import sys
+import tempfile
 
 import falcon
+import igraph
 import numpy as np
 from protgraph.export.peptides.pep_fasta import PepFasta
 
+from cache_utils import GRAPH_CACHE, METADATA_CACHE
+from graph_archive import load_graph_archive
 from prot_graph_exception import ProtGraphException
-from query_weight.query_algorithms import build_pdb
+from query_weight.compact_graph import CompactGraph
+from query_weight.exact_index import ExactIndex, build_exact_index
+from query_weight.pdb_store import load_pdb_store
+from query_weight.query_algorithms import build_pdb, build_top_sort_attrs
+from request_metrics import phase
 
 PF = PepFasta()
 
 
-def get_pdb_path(base_dir, accession: str, graph, k=5):
-    """ Get intervals from graph from numpy file if it exists. If not generate it """
+# The layouts of the base folder: Graphs exported via ProtGraph with "-edirs" (nested, e.g. base/P/1/2/3/4/5.pickle),
+# without it (flat, e.g. base/P12345.pickle) or all graphs packed into one archive (packed, see graph_archive.py).
+# In the packed layout, the other files of a protein (pdbs, top. sorts, ...) are kept flat.
+LAYOUTS = ["nested", "flat", "packed"]
+
+_LAYOUT = "nested"
+
+# The (approximate) memory of igraph per vertex (out and in indices) and per edge (both ends and the indices by them)
+IGRAPH_VERTEX_BYTES = 16
+IGRAPH_EDGE_BYTES = 32
+
+# The types of attribute values, which do not reference other objects
+_SCALAR_TYPES = {int, float, str, bool, type(None)}
+
+
+def set_layout(layout):
+    """ Set the layout of the base folder (this should be done before serving) """
+    global _LAYOUT
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout '{}', choose one of: {}".format(layout, ", ".join(LAYOUTS)))
+    _LAYOUT = layout
+
+
+def get_layout():
+    """ Returns the layout of the base folder """
+    return _LAYOUT
+
+
+def get_protein_file(base_dir, accession: str, extension: str):
+    """ Get the path of a file (by its extension) of a protein, depending on the layout """
     # Check if accession is correct
-    if not accession.isalnum:
+    if not accession.isalnum():
         raise ProtGraphException(
             falcon.HTTP_404,
             json.dumps({"message": "Accession can only consist of +[a-zA-Z0-9]"}, indent=4)
         )
 
-    # Get directory (non flat structure) # TODO maybe we should allow both: flat and nonflat?
-    path = os.path.join(
-        base_dir,
-        *[x for x in accession[:-1]],
-        accession[-1] + ".pdb" + str(k)
-    )
+    if _LAYOUT == "nested":
+        # Get directory (non flat structure)
+        return os.path.join(
+            base_dir,
+            *[x for x in accession[:-1]],
+            accession[-1] + extension
+        )
+    return os.path.join(base_dir, accession + extension)
+
+
+def get_pdb_file(base_dir, accession: str, k=5):
+    """ Get the path of the pdb (numpy) file of a protein """
+    return get_protein_file(base_dir, accession, ".pdb" + str(k))
+
+
+def get_pdb_path(base_dir, accession: str, graph, k=5, use_store=True):
+    """
+    Get intervals from (compact) graph from the consolidated pdb store (if use_store) or numpy file if it exists.
+    If not generate it
+    """
+    path = get_pdb_file(base_dir, accession, k)
+
+    # Lookup in the pdb store first (memory mapped, see query_weight.precompute)
+    store = load_pdb_store(base_dir, k) if use_store else None
+    if store is not None:
+        n_pdb = store.get(accession)
+        if n_pdb is not None:
+            return n_pdb
 
     # Check if the path to the graph file exists
     if not os.path.isfile(path):
-        # Then generate pdb
-        build_pdb(graph, k=k)
+        # Then generate pdb (the graph itself is shared via the cache, so it is not modified)
+        # Save it on disk and return the interval matrix
+        return save_pdb(base_dir, accession, build_pdb(graph, k=k), k)
+
+    # Return the interval matrix
+    return np.load(path)
+
 
-        # Fill entries with nans
-        pdb_entries = [x + [[np.nan, np.nan]]*(k - len(x)) for x in graph.vs["pdb"]]
+def save_pdb(base_dir, accession: str, n_pdb, k=5):
+    """ Save the (built) pdb of a protein and return it as saved """
+    # Without any nans (every node has k intervals), the pdb is kept as integers (as in earlier versions)
+    if not np.isnan(n_pdb).any():
+        n_pdb = n_pdb.astype(np.int64)
+    save_array(get_pdb_file(base_dir, accession, k), n_pdb)
+    return n_pdb
 
-        # Delete entries in graph itself
-        del graph.vs["pdb"]
 
-        # Generate numpy matrix out of these intervals
-        n_pdb = np.array(pdb_entries)
+def get_exact_index_file(base_dir, accession: str, resolution):
+    """ Get the path of the exact index (at the integer resolution) of a protein """
+    return get_protein_file(base_dir, accession, ".exact" + str(resolution))
+
+
+def get_exact_index_path(base_dir, accession: str, graph, resolution, max_weight):
+    """
+    Get the exact index (at the integer resolution, up to max_weight) from the (compact) graph from its file
+    if it exists. If not generate it. It is kept in the graph cache
+    """
+    path = get_exact_index_file(base_dir, accession, resolution)
+
+    # Check if the path to the graph file exists
+    if not os.path.isfile(path):
+        # Then generate the exact index and save it on disk
+        save_atomically(path, build_exact_index(graph, resolution, max_weight).save)
+
+    return GRAPH_CACHE.get(
+        ("exact", base_dir, accession, resolution), path, ExactIndex.load, size=lambda index: index.nbytes
+    )
+
+
+def get_top_sort_path(base_dir, accession: str, graph):
+    """ Get the attribute ordered top. sort of the (compact) graph from numpy file if it exists. If not generate it """
+    path = get_protein_file(base_dir, accession, ".tsa")
+
+    # Check if the path to the graph file exists
+    if not os.path.isfile(path):
+        # Then generate the top. sort
+        n_top_sort = np.array(build_top_sort_attrs(graph), dtype=np.int64)
 
         # Save it on disk:
-        with open(path, "wb") as f:
-            np.save(f, n_pdb)
+        save_array(path, n_top_sort)
 
-        # Return the interval matrix
-        return n_pdb
+        # Return the top. sort
+        return n_top_sort
 
-    # Return the interval matrix
+    # Return the top. sort
     return np.load(path)
 
 
+def save_array(path, array):
+    """ Save a numpy array atomically """
+    save_atomically(path, lambda f: np.save(f, array))
+
+
+def save_atomically(path, write):
+    """
+    Save a file atomically (write(f) writes to a temporary file first), so that concurrent
+    readers (or writers of the same file) never see a partially written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def find_graph_path(base_dir, accession: str):
+    """
+    Gets the path of the file containing the graph of a protein (the data file of the archive in the packed layout).
+    Returns None if the graph is not existing
+    """
+    if _LAYOUT == "packed":
+        archive = load_graph_archive(base_dir)
+        return archive.data_path if archive is not None and accession in archive else None
+
+    path = get_protein_file(base_dir, accession, ".pickle")  # TODO only pickle?, do we want to change this?
+    return path if os.path.isfile(path) else None
+
+
 def get_graph_path(base_dir, accession: str):
     """ Gets the path for a protein. Raises exceptions if accession is invalid or if the graph is not existing """
-    # Check if accession is correct
-    if not accession.isalnum:
-        raise ProtGraphException(
-            falcon.HTTP_404,
-            json.dumps({"message": "Accession can only consist of +[a-zA-Z0-9]"}, indent=4)
-        )
-
-    # Get directory (non flat structure) # TODO maybe we should allow both: flat and nonflat?
-    path = os.path.join(
-        base_dir,
-        *[x for x in accession[:-1]],
-        accession[-1] + ".pickle"  # TODO only pickle?, do we want to change this?
-    )
+    path = find_graph_path(base_dir, accession)
 
     # check if the path to the graph file exists
-    if not os.path.isfile(path):
+    if path is None:
         raise ProtGraphException(
             falcon.HTTP_404,
             json.dumps({"message": "Graph of Protein does not exist!"}, indent=4)
@@ -79,6 +194,118 @@ def get_graph_path(base_dir, accession: str):
     return path
 
 
+def read_graph(base_dir, accession: str, path):
+    """ Reads the graph of a protein from its path (see get_graph_path) """
+    if _LAYOUT == "packed":
+        return load_graph_archive(base_dir).read(accession)
+    return igraph.read(path)
+
+
+def get_binary_graph_file(base_dir, accession: str):
+    """ Get the path of the compact graph in the binary format (see CompactGraph.save) of a protein """
+    return get_protein_file(base_dir, accession, ".npz")
+
+
+def get_binary_graph_path(base_dir, accession: str):
+    """
+    Gets the path of the binary compact graph, if it exists, is not older than the pickled graph
+    and has all columns. Else None
+    """
+    path = get_binary_graph_file(base_dir, accession)
+    if not os.path.isfile(path):
+        return None
+    if not METADATA_CACHE.get(("complete", path), path, CompactGraph.is_complete, size=lambda _: 64):
+        return None
+
+    graph_path = find_graph_path(base_dir, accession)
+    if graph_path is not None and os.path.getmtime(graph_path) > os.path.getmtime(path):
+        return None
+    return path
+
+
+def get_compact_graph_path(base_dir, accession: str):
+    """ Gets the path, from which the compact graph is loaded (the binary format if present, else the graph) """
+    return get_binary_graph_path(base_dir, accession) or get_graph_path(base_dir, accession)
+
+
+def iter_accessions(base_dir):
+    """ Yields the accessions of all graphs in base_dir (sorted) """
+    if _LAYOUT == "packed":
+        archive = load_graph_archive(base_dir)
+        yield from archive.accessions.tolist() if archive is not None else []
+        return
+
+    if _LAYOUT == "flat":
+        yield from sorted(f[:-len(".pickle")] for f in os.listdir(base_dir) if f.endswith(".pickle"))
+        return
+
+    accessions = []
+    for root, dirs, files in os.walk(base_dir):
+        prefix = "".join(os.path.relpath(root, base_dir).split(os.sep)) if root != base_dir else ""
+        for f in files:
+            if f.endswith(".pickle"):
+                accessions.append(prefix + f[:-len(".pickle")])
+    yield from sorted(accessions)
+
+
+def get_graph_size(graph):
+    """
+    Estimates the memory consumption (in bytes) of a graph: The edge and vertex vectors of igraph
+    and the (Python) attribute values, each object counted once
+    """
+    # Keep the attribute lists referenced, so that the ids of their values stay unique
+    objects = [graph.vs[x] for x in graph.vs.attributes()] + [graph.es[x] for x in graph.es.attributes()]
+    size = IGRAPH_VERTEX_BYTES * graph.vcount() + IGRAPH_EDGE_BYTES * graph.ecount()
+    seen = set()
+    while objects:
+        # Visit the objects level by level (the values of the containers of the previous level)
+        new = dict(zip(map(id, objects), objects))
+        for key in seen.intersection(new):
+            del new[key]
+        seen.update(new)
+        size += sum(map(sys.getsizeof, new.values()))
+        objects = []
+        for obj in [x for x in new.values() if type(x) not in _SCALAR_TYPES]:
+            if isinstance(obj, (list, tuple, set)):
+                objects.extend(obj)
+            elif isinstance(obj, dict):
+                objects.extend(obj.keys())
+                objects.extend(obj.values())
+            elif hasattr(obj, "__dict__"):
+                objects.append(vars(obj))
+    return size
+
+
+def load_graph(base_dir, accession: str):
+    """ Loads the graph of a protein. Graphs are kept in the shared graph cache across requests """
+    prot_graph_path = get_graph_path(base_dir, accession)
+    return GRAPH_CACHE.get(
+        ("graph", accession), prot_graph_path, lambda path: read_graph(base_dir, accession, path), size=get_graph_size
+    )
+
+
+def load_compact_graph(base_dir, accession: str):
+    """
+    Loads the compact graph (used by the query algorithms), which is built once and kept in the graph cache.
+    It is loaded from the binary format if present, else it is built from the pickled graph.
+    """
+    binary_graph_path = get_binary_graph_path(base_dir, accession)
+    if binary_graph_path is not None:
+        return GRAPH_CACHE.get(
+            ("compact", accession), binary_graph_path, CompactGraph.load, size=lambda compact: compact.nbytes
+        )
+
+    prot_graph_path = get_graph_path(base_dir, accession)
+
+    def _load(path):
+        compact = CompactGraph.from_graph(read_graph(base_dir, accession, path))
+        with phase("top_sort"):
+            compact.attrs_top_sort = get_top_sort_path(base_dir, accession, compact)
+        return compact
+
+    return GRAPH_CACHE.get(("compact", accession), prot_graph_path, _load, size=lambda compact: compact.nbytes)
+
+
 def check_path_connected(graph, path: list):
     """ raises an exception if path is not connected in graph """
     if not all(map(lambda x: graph.are_connected(x[0], x[1]), zip(path, path[1:]))):
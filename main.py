@@ -1,16 +1,24 @@
 import argparse
 import multiprocessing
 import os
+import signal
+import sys
 
 import falcon
 from falcon_swagger_ui import register_swaggerui_app
 from waitress import serve
 
 import path_to_output
+import prefork
+from cache_utils import GRAPH_CACHE, METADATA_CACHE, RESULT_CACHE
+from graph_utils import LAYOUTS, set_layout
 from prot_graph_exception import ProtGraphException
 from query_weight import mono_weight_query as wq
+from query_weight import parallel
+from query_weight.proteome_query import QueryWeightProteome
+from request_metrics import Metrics, TimingMiddleware
 
-app = application = falcon.API()
+app = application = falcon.API(middleware=[TimingMiddleware()])
 
 
 def parse_args():
@@ -23,17 +31,74 @@ def parse_args():
         "base_folder", type=str,
         help="The base folder containing the generated exported graph files, which can be read by igraph."
     )
+    parser.add_argument(
+        "--layout", "-l", type=str, default="nested", choices=LAYOUTS,
+        help="The layout of the base folder: 'nested' (graphs exported with '-edirs'), 'flat' (graphs exported "
+        "without '-edirs') or 'packed' (graphs packed into an archive via pack_graphs.py). Default is 'nested'."
+    )
     parser.add_argument(
         "--mass_dict_factor", "-mdf", type=float, default=1000000000,
         help="Set the factor for the masses which was used to generate the graphs. "
         "The default is set to 1 000 000 000, so that each mass can be converted into integers."
     )
+    parser.add_argument(
+        "--graph_cache_size", "-gcs", type=int, default=1024,
+        help="Set the memory budget (in MB) of the in-process graph cache, which keeps recently used graphs "
+        "loaded across requests. Set to 0 to disable the cache. The default is set to 1024 MB. "
+        "Each process of the process pool (see '--query_processes') has its own graph cache with the same budget, "
+        "so up to (1 + query_processes) times this budget can be used (per worker)."
+    )
+    parser.add_argument(
+        "--metadata_cache_size", "-mcs", type=int, default=256,
+        help="Set the memory budget (in MB) of the cache of the metadata of the base folder (e.g. the indices "
+        "of the archive, the pdb stores and the mass index). The default is set to 256 MB."
+    )
+    parser.add_argument(
+        "--result_cache_size", "-rcs", type=int, default=256,
+        help="Set the memory budget (in MB) of the cache of weight query results. "
+        "Set to 0 to disable the cache. The default is set to 256 MB."
+    )
+    parser.add_argument(
+        "--result_cache_ttl", "-rct", type=int, default=3600,
+        help="Set the time (in seconds) after which cached weight query results expire. The default is set to 3600."
+    )
+    parser.add_argument(
+        "--query_processes", "-qp", type=int, default=multiprocessing.cpu_count(),
+        help="Set the number of processes, which are used for weight queries with 'parallel' set. "
+        "Set to 0 to execute those queries in the serving process. The default is set to the number of cores. "
+        "Each of these processes inherits (and then fills) its own graph cache of '--graph_cache_size'."
+    )
+    parser.add_argument(
+        "--workers", "-w", type=int, default=1,
+        help="Set the number of serving processes, which are forked (after preloading) and share the listening "
+        "socket. Each worker has its own caches and process pool (see '--query_processes'). "
+        "The default is set to 1 (a single serving process)."
+    )
+    parser.add_argument(
+        "--threads", "-t", type=int, default=None,
+        help="Set the number of threads per serving process. "
+        "The default is set to the number of cores divided by the number of workers (at least 1)."
+    )
+    parser.add_argument(
+        "--preload", "-pl", type=str, nargs="+", default=[],
+        help="Accessions (or files with one accession per line), whose graphs are loaded into the graph cache "
+        "before serving. With multiple workers, they are shared copy-on-write by all of them."
+    )
 
     args = parser.parse_args()
 
     return dict(
         base_folder=args.base_folder,
-        mass_dict_factor=args.mass_dict_factor
+        layout=args.layout,
+        mass_dict_factor=args.mass_dict_factor,
+        graph_cache_size=args.graph_cache_size,
+        metadata_cache_size=args.metadata_cache_size,
+        result_cache_size=args.result_cache_size,
+        result_cache_ttl=args.result_cache_ttl,
+        query_processes=args.query_processes,
+        workers=args.workers,
+        threads=args.threads or max(1, multiprocessing.cpu_count() // args.workers),
+        preload=args.preload
     )
 
 
@@ -51,6 +116,29 @@ def generic_error_handler(ex, req, resp, params):
 if __name__ == '__main__':
     GLOABL_ARGS = parse_args()
 
+    # Set the layout of the base folder
+    set_layout(GLOABL_ARGS["layout"])
+
+    # Set the memory budget of the shared graph cache
+    GRAPH_CACHE.resize(GLOABL_ARGS["graph_cache_size"] * 1024 * 1024)
+
+    # Set the memory budget of the metadata cache
+    METADATA_CACHE.resize(GLOABL_ARGS["metadata_cache_size"] * 1024 * 1024)
+
+    # Set the memory budget and expiration of the result cache
+    RESULT_CACHE.resize(GLOABL_ARGS["result_cache_size"] * 1024 * 1024)
+    RESULT_CACHE.set_ttl(GLOABL_ARGS["result_cache_ttl"])
+
+    # Preload graphs into the graph cache (before any worker or process pool is forked)
+    if GLOABL_ARGS["preload"]:
+        num_preloaded = prefork.preload(GLOABL_ARGS["base_folder"], prefork.read_accessions(GLOABL_ARGS["preload"]))
+        print("Preloaded {} proteins".format(num_preloaded), file=sys.stderr)
+
+    # Start the process pool for parallel weight queries (before any other thread is running).
+    # With multiple workers, each worker starts its own pool after it is forked
+    if GLOABL_ARGS["workers"] <= 1:
+        parallel.start_pool(GLOABL_ARGS["query_processes"])
+
     app.add_error_handler(ProtGraphException, generic_error_handler)
 
     # Add resources folder to:
@@ -93,11 +181,44 @@ if __name__ == '__main__':
         "/{accession}/top_sort_attrs_limit_var/query_mono_weight",
         wq.QueryWeight(GLOABL_ARGS["base_folder"], GLOABL_ARGS["mass_dict_factor"], wq.ALGORITHMS["top_sort_attrs_limit_var"])
     )
+    app.add_route(
+        "/{accession}/bidirectional/query_mono_weight",
+        wq.QueryWeight(GLOABL_ARGS["base_folder"], GLOABL_ARGS["mass_dict_factor"], wq.ALGORITHMS["bidirectional"])
+    )
+
+    # Route for weight queries with multiple weights (single traversal)
+    app.add_route(
+        "/{accession}/top_sort_attrs/query_mono_weights",
+        wq.QueryWeights(GLOABL_ARGS["base_folder"], GLOABL_ARGS["mass_dict_factor"])
+    )
+
+    # Route for weight queries over all proteins (or a list of accessions)
+    app.add_route(
+        "/query_mono_weight",
+        QueryWeightProteome(GLOABL_ARGS["base_folder"], GLOABL_ARGS["mass_dict_factor"])
+    )
+
+    # Route for the metrics (Prometheus)
+    app.add_route("/metrics", Metrics())
 
     # Example call for a query via weight
     # http://localhost:8000/A0A4S5AXF8/top_sort/query_mono_weight?unit=ppm&mono_weight=3394.719&mass_tolerance=5
     # http://localhost:8000/P04637/top_sort/query_mono_weight?unit=ppm&mono_weight=1000.719&mass_tolerance=5&timeout=10
 
+    # Example call for a query via weight over all proteins:
+    # http://localhost:8000/query_mono_weight?unit=ppm&mono_weight=1000.719&mass_tolerance=5&algorithm=top_sort
+
     # Example call for getting a peptide:
     # http://localhost:8000/A0A4S5AXF8/path_to_fasta?path=0,24,25,9
-    serve(app, listen="*:8000", threads=multiprocessing.cpu_count())
+    if GLOABL_ARGS["workers"] > 1:
+        prefork.serve_prefork(
+            app, "*:8000", GLOABL_ARGS["workers"], GLOABL_ARGS["threads"],
+            on_fork=lambda: parallel.start_pool(GLOABL_ARGS["query_processes"]), on_exit=parallel.stop_pool
+        )
+    else:
+        # Terminate (like on an interrupt) on SIGTERM, so that the process pool is shut down as well
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            serve(app, listen="*:8000", threads=GLOABL_ARGS["threads"])
+        finally:
+            parallel.stop_pool()
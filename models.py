@@ -1,6 +1,6 @@
 from typing import List, Literal, Optional
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, conlist, validator
 
 
 class Path(BaseModel):
@@ -12,6 +12,8 @@ class Path(BaseModel):
     paths: Optional[List[List[int]]] = []
     # Set the return type, we always can return json or text here (text -> DEFAULT)
     returns: Optional[Literal["text", "json"]] = "text"
+    # Stream the results, as they are retrieved (json is then returned as NDJSON)
+    stream: Optional[bool] = False
 
     @validator("path", pre=True)
     def convert_str_to_list(cls, v):  # pylint: disable=E0213
@@ -32,9 +34,50 @@ class Path(BaseModel):
         return v
 
 
-class MonoWeigthQuery(BaseModel):
+class BaseMonoWeightQuery(BaseModel):
+    """ BaseClass, which is used to parse the parameters shared by the weight queries (on one or more proteins) """
+
+    # Parse the unit, either ppm or Da, which is used to calculate the interval
+    unit: Literal["ppm", "Da"]
+
+    # Parse the mass tolerance around the mono_weight
+    mass_tolerance: int
+
+    # The weight, which we want to query
+    mono_weight: float
+
+    # The time we want to retrieve the result (in seconds). If it takes longer than timeout, we abort the search
+    timeout: Optional[float] = 10000
+
+    # Set the number of intervals to be used (if not set, the tuned k of the protein or 10 is used)
+    k: Optional[int] = None
+
+    # Limit the number of variants, missed cleavages and other features (e.g. MUTAGEN, CONFLICT) in the peptides
+    limit_variants: Optional[int] = None
+    limit_miscleavages: Optional[int] = None
+    limit_features: Optional[int] = None
+
+    # Prune via the exact index (with the resolution in Da, default 0.01) instead of the pdb (k is then not used)
+    exact: Optional[bool] = False
+    resolution: Optional[float] = None
+
+
+class MonoWeigthQuery(BaseMonoWeightQuery):
     """ BaseClass, which is used to parse one or multiple parameters for weight queries """
 
+    # Split the search space of the query and execute the parts in parallel (in the process pool)
+    parallel: Optional[bool] = False
+
+    # Stream the results as NDJSON, as they are serialized
+    stream: Optional[bool] = False
+
+    # Only count the matching peptides (without retrieving them)
+    count: Optional[bool] = False
+
+
+class Precursor(BaseModel):
+    """ BaseClass, which is used to parse one weight (with its tolerance) of a multi weight query """
+
     # Parse the unit, either ppm or Da, which is used to calculate the interval
     unit: Literal["ppm", "Da"]
 
@@ -44,8 +87,45 @@ class MonoWeigthQuery(BaseModel):
     # The weight, which we want to query
     mono_weight: float
 
+
+class MultiMonoWeightQuery(BaseModel):
+    """ BaseClass, which is used to parse the parameters for weight queries with multiple weights """
+
+    # The weights (with their tolerances), which we want to query at once (at least one)
+    precursors: conlist(Precursor, min_items=1)
+
     # The time we want to retrieve the result (in seconds). If it takes longer than timeout, we abort the search
     timeout: Optional[float] = 10000
 
-    # Set the number of intervals to be used
-    k: Optional[int] = 10
+    # Set the number of intervals to be used (if not set, the tuned k of the protein or 10 is used)
+    k: Optional[int] = None
+
+    # Limit the number of variants, missed cleavages and other features (e.g. MUTAGEN, CONFLICT) in the peptides
+    limit_variants: Optional[int] = None
+    limit_miscleavages: Optional[int] = None
+    limit_features: Optional[int] = None
+
+
+class ProteomeWeightQuery(BaseMonoWeightQuery):
+    """
+    BaseClass, which is used to parse the parameters for weight queries over multiple proteins
+    (always streamed and executed in parallel per protein)
+    """
+
+    # The algorithm, which is used for each protein
+    algorithm: Optional[Literal[
+        "top_sort", "bfs_fifo", "bfs_filo", "dfs", "top_sort_attrs", "top_sort_attrs_limit_var", "bidirectional"
+    ]] = "top_sort_attrs"
+
+    # The accessions, which should be searched (comma seperated). If empty, all proteins are searched
+    accessions: Optional[List[str]] = []
+
+    # Only count the matching peptides per protein (without retrieving them)
+    count: Optional[bool] = False
+
+    @validator("accessions", pre=True)
+    def convert_str_to_list(cls, v):  # pylint: disable=E0213
+        """ Allow accessions seperated by ',' """
+        if isinstance(v, str):
+            return [x for x in v.split(",") if x]
+        return v
@@ -0,0 +1,36 @@
+import argparse
+
+from graph_archive import save_graph_archive
+from graph_utils import get_graph_path, iter_accessions, set_layout
+
+
+def pack_graphs(base_dir):
+    """ Pack all graphs of base_dir (in the current layout) into an archive, which is written into base_dir """
+    accessions = list(iter_accessions(base_dir))
+    save_graph_archive(base_dir, accessions, [get_graph_path(base_dir, accession) for accession in accessions])
+    print("Packed {} graphs".format(len(accessions)))
+
+
+def parse_args():
+    # Arguments for Parser
+    parser = argparse.ArgumentParser(
+        description="Pack all graphs of a base folder into a single archive (with an index of the accessions), "
+        "which can be served via the 'packed' layout instead of one file per protein"
+    )
+    parser.add_argument(
+        "base_folder", type=str,
+        help="The base folder containing the generated exported graph files, which can be read by igraph."
+    )
+    parser.add_argument(
+        "--layout", "-l", type=str, default="nested", choices=["nested", "flat"],
+        help="The layout of the graphs to be packed: 'nested' (graphs exported with '-edirs') or 'flat' "
+        "(graphs exported without '-edirs'). Default is 'nested'."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_layout(args.layout)
+    pack_graphs(args.base_folder)
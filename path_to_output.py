@@ -1,13 +1,13 @@
 import json
 
 import falcon
-import igraph
 
-from graph_utils import (check_path_incorrect, get_aminoacids, get_graph_path,
-                         get_pep_and_header_def)
+from graph_utils import (check_path_incorrect, get_aminoacids,
+                         get_pep_and_header_def, load_graph)
 from models import Path
 from models_utils import load_model
 from prot_graph_exception import ProtGraphException
+from request_metrics import phase
 
 
 def _check_header(req):
@@ -48,54 +48,67 @@ class PathToPeptide(object):
     def __init__(self, base_dir):
         self.base_dir = base_dir
 
-    def _return_content(self, resp, peptides, as_json=True):
-        if as_json:
-            resp.set_header("content-type", "application/json")
-            resp.body = json.dumps(peptides, ensure_ascii=False)
+    def _return_content(self, resp, peptides, as_json=True, stream=False):
+        if stream:
+            # Serialize each peptide as soon as it is retrieved (NDJSON or one per line)
+            resp.set_header("content-type", "application/x-ndjson" if as_json else "text/plain")
+            resp.stream = (
+                ((json.dumps(pep, ensure_ascii=False) if as_json else pep) + "\n").encode()
+                for pep in peptides
+            )
         else:
-            resp.set_header("content-type", "text/plain")
-            resp.body = "\n".join(peptides)
+            with phase("materialize"):
+                peptides = list(peptides)
+            with phase("serialize"):
+                if as_json:
+                    resp.set_header("content-type", "application/json")
+                    resp.body = json.dumps(peptides, ensure_ascii=False)
+                else:
+                    resp.set_header("content-type", "text/plain")
+                    resp.body = "\n".join(peptides)
         resp.status = falcon.HTTP_200
 
-    def _get_peptides(self, resp, prot_graph_path, paths):
+    def _get_peptides(self, resp, accession, paths):
         _check_paths_length(paths)
 
         # Load graph
-        graph = igraph.read(prot_graph_path)
+        with phase("graph_load"):
+            graph = load_graph(self.base_dir, accession)
 
-        # For each path retrieve the peptide sequence:
-        peptides = []
-        for path in paths:
-            check_path_incorrect(graph, path)
-            peptides.append(get_aminoacids(graph, path[1:-1]))
+        # Check all paths first (so that errors are not raised while streaming)
+        with phase("check"):
+            for path in paths:
+                check_path_incorrect(graph, path)
 
-        return peptides
+        # For each path retrieve the peptide sequence (lazily):
+        return (get_aminoacids(graph, path[1:-1]) for path in paths)
 
     def on_get(self, req, resp, accession):
-        # Get Protein depending on accession and path
-        prot_graph_path = get_graph_path(self.base_dir, accession)
+        # Get path(s)
         path_obj = load_model(Path, req.params)
         paths = _concat_paths(path_obj)
 
         # Get peptides
-        peptides = self._get_peptides(resp, prot_graph_path, paths)
+        peptides = self._get_peptides(resp, accession, paths)
 
         # Return the content depending on return type
-        self._return_content(resp, peptides, path_obj.returns == "json")
+        self._return_content(resp, peptides, path_obj.returns == "json", path_obj.stream)
 
     def on_post(self, req, resp, accession):
         # Check headers
         _check_header(req)
-        # Get Protein depending on accession and path
-        prot_graph_path = get_graph_path(self.base_dir, accession)
+        # Get path(s)
         path_obj_query, path_obj_body = load_model(Path, req.params, req.media)
         paths = _concat_paths(path_obj_query, path_obj_body)
 
         # Get peptides
-        peptides = self._get_peptides(resp, prot_graph_path, paths)
+        peptides = self._get_peptides(resp, accession, paths)
 
         # Return the content depending on return type
-        self._return_content(resp, peptides, "json" in [path_obj_query.returns, path_obj_body.returns])
+        self._return_content(
+            resp, peptides, "json" in [path_obj_query.returns, path_obj_body.returns],
+            path_obj_query.stream or path_obj_body.stream
+        )
 
 
 class PathToFasta(object):
@@ -103,68 +116,88 @@ class PathToFasta(object):
     def __init__(self, base_dir):
         self.base_dir = base_dir
 
-    def _return_content(self, resp, peptides, as_json=True):
-        if as_json:
-            content = []
-            for idx, (pep, header) in enumerate(peptides):
-                content.append(
-                    {
-                        "head": ">pg|ID_" + str(idx) + "|" + header,
-                        "seq": pep
-                    }
-                )
-            resp.set_header("content-type", "application/json")
-            resp.body = json.dumps(content, ensure_ascii=False)
+    @staticmethod
+    def _to_dict(idx, pep, header):
+        """ A peptide as json entry """
+        return {
+            "head": ">pg|ID_" + str(idx) + "|" + header,
+            "seq": pep
+        }
+
+    @staticmethod
+    def _to_fasta(idx, pep, header):
+        """ A peptide as FASTA entry """
+        return ">pg|ID_" + str(idx) + "|" + header + \
+            "\n" + '\n'.join(pep[i:i+60] for i in range(0, len(pep), 60)) + "\n"
+
+    def _return_content(self, resp, peptides, as_json=True, stream=False):
+        if stream:
+            # Serialize each peptide as soon as it is retrieved (NDJSON or FASTA)
+            resp.set_header("content-type", "application/x-ndjson" if as_json else "text/plain")
+            resp.stream = (
+                (
+                    json.dumps(self._to_dict(idx, pep, header), ensure_ascii=False) + "\n" if as_json
+                    else self._to_fasta(idx, pep, header)
+                ).encode()
+                for idx, (pep, header) in enumerate(peptides)
+            )
         else:
-            content = ""
-            for idx, (pep, header) in enumerate(peptides):
-                content += ">pg|ID_" + str(idx) + "|" + header
-                content += "\n" + '\n'.join(pep[i:i+60] for i in range(0, len(pep), 60)) + "\n"
-            resp.set_header("content-type", "text/plain")
-            resp.body = content
+            with phase("materialize"):
+                peptides = list(peptides)
+            with phase("serialize"):
+                if as_json:
+                    resp.set_header("content-type", "application/json")
+                    resp.body = json.dumps(
+                        [self._to_dict(idx, pep, header) for idx, (pep, header) in enumerate(peptides)],
+                        ensure_ascii=False
+                    )
+                else:
+                    resp.set_header("content-type", "text/plain")
+                    resp.body = "".join(
+                        self._to_fasta(idx, pep, header) for idx, (pep, header) in enumerate(peptides)
+                    )
         resp.status = falcon.HTTP_200
 
-    def _get_peptides(self, resp, prot_graph_path, paths):
+    def _get_peptides(self, resp, accession, paths):
         _check_paths_length(paths)
 
         # Load graph
-        graph = igraph.read(prot_graph_path)
+        with phase("graph_load"):
+            graph = load_graph(self.base_dir, accession)
 
-        # For each path retrieve the peptide sequence:
-        peptides = []
-        for path in paths:
-            check_path_incorrect(graph, path)
-            pep, header = get_pep_and_header_def(path, graph)
-            peptides.append((pep, header))
+        # Check all paths first (so that errors are not raised while streaming)
+        with phase("check"):
+            for path in paths:
+                check_path_incorrect(graph, path)
 
-        return peptides
+        # For each path retrieve the peptide sequence and header (lazily):
+        return (get_pep_and_header_def(path, graph) for path in paths)
 
     def on_get(self, req, resp, accession):
-        # Get Protein depending on accession and path
-        prot_graph_path = get_graph_path(self.base_dir, accession)
+        # Get path(s)
         path_obj = load_model(Path, req.params)
         paths = _concat_paths(path_obj)
 
         # Get peptides
-        peptides = self._get_peptides(resp, prot_graph_path, paths)
+        peptides = self._get_peptides(resp, accession, paths)
 
         # Return the content depending on return type
         self._return_content(
-            resp, peptides, path_obj.returns == "json"
+            resp, peptides, path_obj.returns == "json", path_obj.stream
         )
 
     def on_post(self, req, resp, accession):
         # Check headers
         _check_header(req)
-        # Get Protein depending on accession and path
-        prot_graph_path = get_graph_path(self.base_dir, accession)
+        # Get path(s)
         path_obj_query, path_obj_body = load_model(Path, req.params, req.media)
         paths = _concat_paths(path_obj_query, path_obj_body)
 
         # Get peptides
-        peptides = self._get_peptides(resp, prot_graph_path, paths)
+        peptides = self._get_peptides(resp, accession, paths)
 
         # Return the content depending on return type
         self._return_content(
-            resp, peptides, "json" in [path_obj_query.returns, path_obj_body.returns]
+            resp, peptides, "json" in [path_obj_query.returns, path_obj_body.returns],
+            path_obj_query.stream or path_obj_body.stream
         )
@@ -0,0 +1,130 @@
+import gc
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+from waitress import serve
+from waitress.adjustments import Adjustments
+
+from graph_utils import load_compact_graph, load_graph
+from prot_graph_exception import ProtGraphException
+
+# Workers exiting earlier than this (in seconds) after their start are restarted with a delay (e.g. on startup errors)
+MIN_UPTIME = 1
+
+
+def read_accessions(entries):
+    """ Returns the accessions to preload. Entries are accessions or files with one accession per line """
+    accessions = []
+    for entry in entries:
+        if os.path.isfile(entry):
+            with open(entry) as f:
+                accessions.extend(x.strip() for x in f if x.strip())
+        else:
+            accessions.append(entry)
+    return accessions
+
+
+def preload(base_dir, accessions):
+    """
+    Loads the graphs and compact graphs of the accessions into the graph cache (before the workers are forked),
+    so that they are shared copy-on-write by all workers. Missing graphs are skipped.
+    Returns the number of preloaded proteins.
+    """
+    loaded = 0
+    for accession in accessions:
+        try:
+            load_graph(base_dir, accession)
+            load_compact_graph(base_dir, accession)
+            loaded += 1
+        except ProtGraphException as ex:
+            print("Skipped preloading {}: {}".format(accession, json.loads(ex.body)["message"]), file=sys.stderr)
+    return loaded
+
+
+def bind_sockets(listen):
+    """ Binds and listens on the sockets of listen (as in waitress, e.g. '*:8000'), which are shared by the workers """
+    adj = Adjustments(listen=listen)
+    sockets = []
+    for family, socktype, proto, sockaddr in adj.listen:
+        sock = socket.socket(family, socktype, proto)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(sockaddr)
+        sock.listen(adj.backlog)
+        sockets.append(sock)
+    return sockets
+
+
+def serve_prefork(app, listen, workers, threads, on_fork=None, on_exit=None):
+    """
+    Serves app with workers many forked processes (each with waitress and threads many threads), which accept
+    the connections on the same listening sockets. Everything loaded before (e.g. via preload) is shared
+    copy-on-write. on_fork is called in each worker after it is forked (e.g. to start its own process pool)
+    and on_exit once it stops serving. Workers which exit are restarted, until this (supervising) process
+    is interrupted or terminated.
+    """
+    sockets = bind_sockets(listen)
+
+    # Keep the preloaded objects out of the garbage collection, so that it does not write to (and copy) their pages
+    gc.freeze()
+
+    def _spawn():
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        # In the worker: Never return into the code of the supervising process
+        status = 1
+        try:
+            if on_fork is not None:
+                on_fork()
+            try:
+                # Waitress stops serving on an interrupt (or SIGTERM, see below)
+                serve(app, sockets=sockets, threads=threads)
+            finally:
+                if on_exit is not None:
+                    on_exit()
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        finally:
+            os._exit(status)
+
+    # Terminate (like on an interrupt) on SIGTERM, so that the workers are terminated as well.
+    # The workers inherit it, so they stop serving and call on_exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    children = dict()  # pid -> start time
+    try:
+        for _ in range(workers):
+            children[_spawn()] = time.monotonic()
+        print("Serving on {} with {} workers".format(listen, workers), file=sys.stderr)
+
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            print("Worker {} exited (status {}), restarting it".format(pid, status), file=sys.stderr)
+            if time.monotonic() - started < MIN_UPTIME:
+                time.sleep(MIN_UPTIME)
+            children[_spawn()] = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        for sock in sockets:
+            sock.close()
@@ -0,0 +1,183 @@
+import copy
+
+import numpy as np
+
+from query_weight.query_algorithms import _count_features, _resolve_or
+
+# Qualifiers, which are not counted as (other) features: variants (counted separately) and isoforms
+_NO_FEATURES = {"VARIANT", "VAR_SEQ"}
+
+
+class CompactGraph(object):
+    """
+    Read-only compact representation of a protein graph, which is used by the query algorithms.
+    The out-edges are stored in CSR form: the out-edges of node n are at the positions
+    out_offsets[n]:out_offsets[n+1] of out_targets, out_eids (the edge ids in the igraph graph),
+    out_weights and the counts of variants, missed cleavages and other features (variant_counts,
+    miscleavage_counts and feature_counts, which can be limited in queries).
+
+    Node attributes are kept as columns. Missing positions are set to -inf. The column residues
+    contains the aminoacids, where __start__ and __end__ are empty (used to build the sequences of paths).
+    The attribute ordered top. sort (attrs_top_sort) is set when it is loaded (or built) for the first time.
+    The forward pdbs (per k, used by the bidirectional search) and the minimum counts per node
+    (per limit and direction, see _get_limits) are built on demand.
+    """
+
+    # Attributes, which are stored per out-edge (in CSR order)
+    EDGE_COLUMNS = [
+        "out_targets", "out_eids", "out_weights", "variant_counts", "miscleavage_counts", "feature_counts"
+    ]
+
+    # Columns, which are stored in the binary format (all constructor arguments) and the string columns of these
+    COLUMNS = [
+        "out_offsets", *EDGE_COLUMNS, "aminoacid", "accession", "isoform_accession",
+        "position", "isoform_position", "top_sort", "attrs_top_sort"
+    ]
+    STRING_COLUMNS = ["aminoacid", "accession", "isoform_accession"]
+
+    def __init__(
+        self, out_offsets, out_targets, out_eids, out_weights, variant_counts, miscleavage_counts, feature_counts,
+        aminoacid, accession, isoform_accession, position, isoform_position, top_sort, attrs_top_sort=None
+    ):
+        self.out_offsets = out_offsets
+        self.out_targets = out_targets
+        self.out_eids = out_eids
+        self.out_weights = out_weights
+        self.variant_counts = variant_counts
+        self.miscleavage_counts = miscleavage_counts
+        self.feature_counts = feature_counts
+        self.aminoacid = aminoacid
+        self.accession = accession
+        self.isoform_accession = isoform_accession
+        self.position = position
+        self.isoform_position = isoform_position
+        self.top_sort = top_sort
+        self.attrs_top_sort = attrs_top_sort
+        self.forward_pdbs = dict()
+        self.min_counts = dict()
+
+        self.vcount = len(out_offsets) - 1
+        self.ecount = len(out_targets)
+        self.in_degree = np.bincount(out_targets, minlength=self.vcount).astype(np.int64)
+        self.residues = np.where(np.isin(aminoacid, ["__start__", "__end__"]), "", aminoacid).astype(object)
+
+        # Set start and end node (which are unique!)
+        [self.start] = np.flatnonzero(aminoacid == "__start__").tolist()
+        [self.end] = np.flatnonzero(aminoacid == "__end__").tolist()
+
+    @classmethod
+    def from_graph(cls, graph):
+        """ Generate the compact form of an igraph graph """
+        # The out-edges in the same order as graph.incident(node, mode="OUT")
+        inc_list = graph.get_inclist(mode="OUT")
+        out_offsets = np.zeros(graph.vcount() + 1, dtype=np.int64)
+        out_offsets[1:] = np.cumsum([len(x) for x in inc_list])
+        out_eids = np.fromiter((e for x in inc_list for e in x), dtype=np.int64, count=graph.ecount())
+
+        targets = np.array([e.target for e in graph.es], dtype=np.int64)
+        weights = np.array(graph.es["mono_weight"], dtype=np.int64)
+        e_attrs = graph.es.attributes()
+        if "qualifiers" in e_attrs:
+            variant_counts = np.array(
+                [_resolve_or(x, "VARIANT", min) for x in graph.es["qualifiers"]], dtype=np.int64
+            )
+            feature_counts = np.array(
+                [_count_features(x, lambda t: t not in _NO_FEATURES, min) for x in graph.es["qualifiers"]],
+                dtype=np.int64
+            )
+        else:
+            variant_counts = np.zeros(graph.ecount(), dtype=np.int64)
+            feature_counts = np.zeros(graph.ecount(), dtype=np.int64)
+        if "cleaved" in e_attrs:
+            miscleavage_counts = np.array([1 if x else 0 for x in graph.es["cleaved"]], dtype=np.int64)
+        else:
+            miscleavage_counts = np.zeros(graph.ecount(), dtype=np.int64)
+
+        v_attrs = graph.vs.attributes()
+        accession = np.array(graph.vs["accession"], dtype=object)
+        if "isoform_accession" in v_attrs:
+            isoform_accession = np.array([x if x else "" for x in graph.vs["isoform_accession"]], dtype=object)
+        else:
+            isoform_accession = np.full(graph.vcount(), "", dtype=object)
+
+        return cls(
+            out_offsets,
+            targets[out_eids],
+            out_eids,
+            weights[out_eids],
+            variant_counts[out_eids],
+            miscleavage_counts[out_eids],
+            feature_counts[out_eids],
+            np.array(graph.vs["aminoacid"], dtype=object),
+            accession,
+            isoform_accession,
+            _position_column(graph.vs["position"]),
+            _position_column(graph.vs["isoform_position"] if "isoform_position" in v_attrs else [None]*graph.vcount()),
+            np.array(graph.topological_sorting(), dtype=np.int64)
+        )
+
+    def save(self, f):
+        """
+        Save the compact graph in a binary (columnar) format (npz) into the file f.
+        The string columns are stored as fixed width unicode arrays, so no pickling is needed.
+        """
+        columns = {c: getattr(self, c) for c in self.COLUMNS if getattr(self, c) is not None}
+        for c in self.STRING_COLUMNS:
+            columns[c] = np.array(columns[c].tolist(), dtype=str)
+        np.savez(f, **columns)
+
+    @classmethod
+    def load(cls, path):
+        """ Load a compact graph saved in the binary format """
+        with np.load(path, allow_pickle=False) as npz:
+            return cls(**{c: npz[c] for c in npz.files})
+
+    @classmethod
+    def is_complete(cls, path):
+        """ Checks if a compact graph in the binary format has all columns (files of older versions may lack some) """
+        with np.load(path, allow_pickle=False) as npz:
+            return all(c in npz.files for c in cls.COLUMNS if c != "attrs_top_sort")
+
+    @property
+    def nbytes(self):
+        """ The (estimated) memory consumption in bytes """
+        numeric = sum(
+            x.nbytes for x in [
+                self.out_offsets, self.out_targets, self.out_eids, self.out_weights, self.variant_counts,
+                self.miscleavage_counts, self.feature_counts, self.position, self.isoform_position, self.top_sort,
+                self.in_degree
+            ]
+        )
+        if self.attrs_top_sort is not None:
+            numeric += self.attrs_top_sort.nbytes
+        numeric += sum(x.nbytes for x in self.min_counts.values())
+        # Object columns hold references to (mostly short) strings
+        return numeric + 64 * (
+            len(self.aminoacid) + len(self.residues) + len(self.accession) + len(self.isoform_accession)
+        )
+
+    def with_start_edges(self, positions):
+        """
+        Returns a view of this graph, where only the out-edges of the start node at the given CSR positions
+        are kept. This is used to split up the search space of a query.
+        """
+        lo, hi = self.out_offsets[self.start], self.out_offsets[self.start + 1]
+        keep = np.ones(self.ecount, dtype=bool)
+        keep[lo:hi] = False
+        keep[positions] = True
+
+        view = copy.copy(self)
+        view.out_offsets = self.out_offsets.copy()
+        view.out_offsets[self.start + 1:] -= (hi - lo) - np.count_nonzero(keep[lo:hi])
+        for column in self.EDGE_COLUMNS:
+            setattr(view, column, getattr(self, column)[keep])
+        view.ecount = len(view.out_targets)
+        view.in_degree = np.bincount(view.out_targets, minlength=self.vcount).astype(np.int64)
+        view.forward_pdbs = dict()
+        view.min_counts = dict()
+        return view
+
+
+def _position_column(positions):
+    """ Convert positions into a float column (None or 0 are set to -inf) """
+    return np.array([x if x else float("-inf") for x in positions], dtype=np.float64)
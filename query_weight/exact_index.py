@@ -0,0 +1,146 @@
+import numpy as np
+
+from query_weight.query_algorithms import _get_in_edges
+
+# The default resolution (in Da) of the exact index
+DEFAULT_RESOLUTION = 0.01
+
+# The weight (in Da), up to which the weights are kept exact. Larger weights are merged into one open interval,
+# since the number of weights to the end grows exponentially with the length of the paths
+MAX_WEIGHT = 6000
+
+# The end of the open interval
+_INFINITY = np.iinfo(np.int64).max // 4
+
+
+def get_integer_resolution(weight_factor, resolution=None):
+    """
+    Converts a resolution (in Da, DEFAULT_RESOLUTION if not set) into the resolution of the integer weights.
+    Returns it and the (integer) maximum weight, which is kept exact
+    """
+    return max(1, int(round(weight_factor * (resolution or DEFAULT_RESOLUTION)))), int(weight_factor * MAX_WEIGHT)
+
+
+class ExactIndex(object):
+    """
+    Alternative to the pdb: For each node it contains the exact set of weights of the paths to the end node
+    at a resolution. The weights of a node are kept as sorted, disjoint intervals (lows and highs, in CSR form
+    at offsets[n]:offsets[n+1]), where all weights in one bin of the resolution are merged into one interval.
+    So the intervals never span more than one bin and only weights within the resolution are let through
+    (up to max_weight, larger weights are kept as one open interval at the end).
+
+    It is used like the pdb (index[nodes] returns the intervals of the nodes, see _func_dist_vec).
+    """
+
+    def __init__(self, offsets, lows, highs, resolution, max_weight):
+        self.offsets = offsets
+        self.lows = lows
+        self.highs = highs
+        self.resolution = resolution
+        self.max_weight = max_weight
+
+    def __getitem__(self, nodes):
+        """ Returns the intervals of the nodes (an array of node ids) """
+        bounds = zip(self.offsets[nodes].tolist(), self.offsets[nodes + 1].tolist())
+        return _Intervals([(self.lows[lo:hi], self.highs[lo:hi]) for lo, hi in bounds])
+
+    @property
+    def nbytes(self):
+        """ The (estimated) memory consumption in bytes """
+        return self.offsets.nbytes + self.lows.nbytes + self.highs.nbytes
+
+    def build_forward(self, graph):
+        """ Builds the forward index (of the weights from the start node) of graph at the same resolution """
+        return build_exact_index(graph, self.resolution, self.max_weight, forward=True)
+
+    def save(self, f):
+        """ Save the index (npz) into the file f """
+        np.savez(
+            f, offsets=self.offsets, lows=self.lows, highs=self.highs, resolution=self.resolution,
+            max_weight=self.max_weight
+        )
+
+    @classmethod
+    def load(cls, path):
+        """ Load a saved index """
+        with np.load(path, allow_pickle=False) as npz:
+            return cls(npz["offsets"], npz["lows"], npz["highs"], int(npz["resolution"]), int(npz["max_weight"]))
+
+
+class _Intervals(object):
+    """ The intervals (lows and highs) of d nodes (retrieved via ExactIndex[nodes]) """
+
+    def __init__(self, intervals):
+        self.intervals = intervals
+
+    def overlaps(self, lows, highs):
+        """ Checks for each node i, if any of its intervals overlaps [lows[..., i], highs[..., i]] """
+        lows, highs = np.broadcast_arrays(lows, highs)
+        result = np.zeros(lows.shape, dtype=bool)
+        for idx, (n_lows, n_highs) in enumerate(self.intervals):
+            if len(n_lows) == 0:
+                # Not reachable
+                continue
+            # The first interval ending at or after the low
+            index = np.minimum(np.searchsorted(n_highs, lows[..., idx]), len(n_lows) - 1)
+            result[..., idx] = (n_highs[index] >= lows[..., idx]) & (n_lows[index] <= highs[..., idx])
+        return result
+
+
+def build_exact_index(graph, resolution, max_weight, forward=False):
+    """
+    Generates the exact index (of the weights to the end node) at the resolution up to max_weight (integer weights).
+    Like the pdb, it is built via the rev. top. sort (or via the top. sort and the in-edges, if forward).
+    """
+    if forward:
+        in_offsets, in_sources, in_weights = _get_in_edges(graph)
+        order, offsets, neighbors, weights = graph.top_sort.tolist(), in_offsets, in_sources, in_weights
+    else:
+        order, offsets, neighbors, weights = (
+            graph.top_sort[::-1].tolist(), graph.out_offsets, graph.out_targets, graph.out_weights
+        )
+    offsets, neighbors, weights = offsets.tolist(), neighbors.tolist(), weights.tolist()
+
+    empty = np.zeros(0, dtype=np.int64)
+    lows, highs = [empty]*graph.vcount, [empty]*graph.vcount
+
+    # Initial interval
+    lows[order[0]], highs[order[0]] = np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+
+    for node in order[1:]:
+        edges = range(offsets[node], offsets[node + 1])
+        if len(edges) == 0:
+            continue
+        n_lows = np.concatenate([lows[neighbors[e]] + weights[e] for e in edges])
+        n_highs = np.concatenate([highs[neighbors[e]] + weights[e] for e in edges])
+        if len(n_lows) == 0:
+            # Not reachable
+            continue
+
+        # Keep only the intervals starting up to max_weight (the others are merged into the open interval)
+        exceeding = n_lows > max_weight
+        overflow = bool(exceeding.any())
+        n_lows, n_highs = n_lows[~exceeding], n_highs[~exceeding]
+
+        # Split the (shifted) intervals crossing a bin (they never span more than two bins)
+        crossing = n_lows // resolution != n_highs // resolution
+        boundaries = (n_highs[crossing] // resolution) * resolution
+        n_lows = np.concatenate([n_lows, boundaries])
+        n_highs = np.concatenate([
+            np.where(crossing, (n_highs // resolution) * resolution - 1, n_highs), n_highs[crossing]
+        ])
+
+        # Merge the intervals per bin
+        bins = n_lows // resolution
+        sorting = np.argsort(bins, kind="stable")
+        bins, n_lows, n_highs = bins[sorting], n_lows[sorting], n_highs[sorting]
+        starts = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+        lows[node] = np.minimum.reduceat(n_lows, starts) if len(n_lows) != 0 else empty
+        highs[node] = np.maximum.reduceat(n_highs, starts) if len(n_lows) != 0 else empty
+        if overflow:
+            lows[node] = np.append(lows[node], max_weight + 1)
+            highs[node] = np.append(highs[node], _INFINITY)
+
+    index_offsets = np.zeros(graph.vcount + 1, dtype=np.int64)
+    index_offsets[1:] = np.cumsum([len(x) for x in lows])
+    return ExactIndex(index_offsets, np.concatenate(lows), np.concatenate(highs), resolution, max_weight)
@@ -0,0 +1,100 @@
+import json
+import os
+import random
+
+import numpy as np
+
+import query_weight.query_algorithms as qa
+from cache_utils import METADATA_CACHE
+from graph_utils import (get_pdb_file, get_protein_file, save_atomically,
+                         save_pdb)
+
+# The candidates for k (number of intervals per node in the pdb)
+CANDIDATE_KS = [5, 10, 20, 40, 80]
+
+# The k, which is used if a protein was not tuned (or all candidates timed out)
+DEFAULT_K = 10
+
+# The number of sampled queries (around the weights of random peptides) and their tolerance (in ppm)
+NUM_QUERIES = 10
+TOLERANCE = 10
+
+# The timeout (in seconds) of the sampled queries per k. Candidates exceeding it are not chosen
+TIMEOUT = 5
+
+# A larger k needs to reduce the work of the queries by at least this ratio (it inflates the pdb)
+MIN_GAIN = 0.1
+
+
+def sample_peptide_weights(graph, num, seed=0):
+    """ Samples the weights of num many peptides (random walks from start to end in the compact graph) """
+    rng = random.Random(seed)
+    weights = []
+    for _ in range(num):
+        node, weight = graph.start, 0
+        while node != graph.end and graph.out_offsets[node] != graph.out_offsets[node + 1]:
+            edge = rng.randrange(graph.out_offsets[node], graph.out_offsets[node + 1])
+            node, weight = int(graph.out_targets[edge]), weight + int(graph.out_weights[edge])
+        weights.append(weight)
+    return weights
+
+
+def tune_k(graph, ks=CANDIDATE_KS):
+    """
+    Measures the work (expansions and prunes) of sampled queries with the pdb of each k (built in memory).
+    Returns the best k (a larger k is only chosen, if it reduces the work by MIN_GAIN; DEFAULT_K if all timed out),
+    the work per k (None if timed out) and the pdb of the best k (None if all timed out).
+    """
+    weights = sample_peptide_weights(graph, NUM_QUERIES)
+    work = dict()
+    best_k, best_pdb = DEFAULT_K, None
+    for k in sorted(ks):
+        n_pdb = qa.build_pdb(graph, k=k)
+        stats, deadline = qa.SearchStats(), qa.Deadline(TIMEOUT)
+        for w in weights:
+            q_interval = np.array([w - (w / 1000000) * TOLERANCE, w + (w / 1000000) * TOLERANCE])
+            qa.top_sort_query(graph.start, graph.end, q_interval, graph, n_pdb, _deadline=deadline, _stats=stats)
+        work[k] = None if deadline.expired else stats.expansions + stats.prunes
+
+        # Only the pdb of the best k (so far) is kept
+        if work[k] is not None and (best_pdb is None or work[k] <= work[best_k] * (1 - MIN_GAIN)):
+            best_k, best_pdb = k, n_pdb
+    return best_k, work, best_pdb
+
+
+def get_tuned_k_file(base_dir, accession: str):
+    """ Get the path of the file with the tuned k of a protein """
+    return get_protein_file(base_dir, accession, ".k")
+
+
+def save_tuned_k(base_dir, accession: str, graph):
+    """
+    Tune k for a protein and save it (with the measured work per k).
+    Only the pdb of the tuned k is saved (if not present), since only it is used by the queries
+    """
+    k, work, n_pdb = tune_k(graph)
+    if n_pdb is not None and not os.path.isfile(get_pdb_file(base_dir, accession, k)):
+        save_pdb(base_dir, accession, n_pdb, k)
+    save_atomically(
+        get_tuned_k_file(base_dir, accession), lambda f: f.write(json.dumps(dict(k=k, work=work)).encode())
+    )
+    return k
+
+
+def get_k(base_dir, accession: str, graph, k=None):
+    """
+    Returns k or, if not set, the tuned k of the protein (DEFAULT_K if it was not tuned).
+    Proteins are only tuned offline (see query_weight.precompute), since tuning takes up to several seconds.
+    """
+    if k is not None:
+        return k
+
+    path = get_tuned_k_file(base_dir, accession)
+    if not os.path.isfile(path):
+        return DEFAULT_K
+
+    def _load(path):
+        with open(path) as f:
+            return json.load(f)["k"]
+
+    return METADATA_CACHE.get(("tuned_k", base_dir, accession), path, _load, size=lambda _: 64)
@@ -0,0 +1,119 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+
+import query_weight.query_algorithms as qa
+from cache_utils import METADATA_CACHE
+from graph_utils import (LAYOUTS, get_pdb_path, iter_accessions,
+                         load_compact_graph, save_atomically, set_layout)
+
+MASS_INDEX_FILE = "mass_index.npz"
+
+
+class MassIndex(object):
+    """
+    Index over all proteins of a base folder. It contains the root intervals (the row of the start node
+    in the pdb) of each protein, which cover the masses of all its peptides (paths from start to end).
+    """
+
+    def __init__(self, accessions, intervals, k):
+        self.accessions = accessions  # sorted
+        self.intervals = intervals  # (num_proteins, k, 2), filled with nans
+        self.k = k
+        self.min_weights = np.nanmin(intervals[:, :, 0], axis=1)
+        self.max_weights = np.nanmax(intervals[:, :, 1], axis=1)
+
+    @property
+    def nbytes(self):
+        """ The (estimated) memory consumption in bytes """
+        return self.accessions.nbytes + self.intervals.nbytes + self.min_weights.nbytes + self.max_weights.nbytes
+
+    def filter(self, accessions, q_interval):
+        """ Discard the accessions, which cannot match q_interval. Accessions not in the index are kept. """
+        if len(self.accessions) == 0:
+            return list(accessions)
+
+        accessions = np.array(accessions, dtype=str)
+        idx = np.minimum(np.searchsorted(self.accessions, accessions), len(self.accessions) - 1)
+        indexed = self.accessions[idx] == accessions
+
+        match = qa._func_dist_vec(self.intervals[idx], q_interval, np.zeros(len(accessions)))
+        return accessions[~indexed | match].tolist()
+
+
+def build_mass_index(base_dir, k=10, progress=None, exclude=()):
+    """
+    Builds the mass index over all proteins in base_dir (pdbs are generated if not present), except the
+    accessions in exclude. If set, progress(accession, number of added proteins) is called after each protein
+    """
+    exclude = set(exclude)
+    accessions, intervals = [], []
+    for accession in iter_accessions(base_dir):
+        if accession in exclude:
+            continue
+        graph = load_compact_graph(base_dir, accession)
+        n_pdb = get_pdb_path(base_dir, accession, graph, k)
+        accessions.append(accession)
+        intervals.append(n_pdb[graph.start])
+        if progress is not None:
+            progress(accession, len(accessions))
+
+    return MassIndex(np.array(accessions, dtype=str), np.array(intervals).reshape(-1, k, 2), k)
+
+
+def print_progress(accession, num_proteins):
+    """ Reports the progress of build_mass_index (in one line on stderr) """
+    print("\rAdded {} ({} proteins)".format(accession, num_proteins), end="", file=sys.stderr, flush=True)
+
+
+def save_mass_index(base_dir, mass_index):
+    """ Save the mass index (atomically, so that running servers never see a partially written file) """
+    save_atomically(
+        os.path.join(base_dir, MASS_INDEX_FILE),
+        lambda f: np.savez(f, accessions=mass_index.accessions, intervals=mass_index.intervals, k=mass_index.k)
+    )
+
+
+def load_mass_index(base_dir):
+    """ Load the mass index of base_dir (kept in the cache). Returns None, if it was not built """
+    path = os.path.join(base_dir, MASS_INDEX_FILE)
+    if not os.path.isfile(path):
+        return None
+
+    def _load(path):
+        with np.load(path) as npz:
+            return MassIndex(npz["accessions"], npz["intervals"], int(npz["k"]))
+
+    return METADATA_CACHE.get(("mass_index", base_dir), path, _load, size=lambda mass_index: mass_index.nbytes)
+
+
+def parse_args():
+    # Arguments for Parser
+    parser = argparse.ArgumentParser(
+        description="(Re)build the mass index over all proteins of a base folder, "
+        "which is used to skip proteins in weight queries over multiple proteins"
+    )
+    parser.add_argument(
+        "base_folder", type=str,
+        help="The base folder containing the generated exported graph files, which can be read by igraph."
+    )
+    parser.add_argument(
+        "--layout", "-l", type=str, default="nested", choices=LAYOUTS,
+        help="The layout of the base folder: 'nested' (graphs exported with '-edirs'), 'flat' (graphs exported "
+        "without '-edirs') or 'packed' (graphs packed into an archive via pack_graphs.py). Default is 'nested'."
+    )
+    parser.add_argument(
+        "--k", "-k", type=int, default=10,
+        help="The number of intervals per protein. The default is set to 10."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_layout(args.layout)
+    save_mass_index(args.base_folder, build_mass_index(args.base_folder, args.k, print_progress))
+    print(file=sys.stderr)
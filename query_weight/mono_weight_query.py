@@ -1,28 +1,33 @@
-import ctypes
-import inspect
+import hashlib
 import json
-import threading
-import time
+import os
 import timeit
+from datetime import datetime
 
 import falcon
-import igraph
 import numpy as np
-from protgraph.aa_masses_annotation import _get_mass_dict
 
 import query_weight.query_algorithms as qa
-from graph_utils import get_graph_path, get_pdb_path, get_start_and_end_node
-from models import MonoWeigthQuery
+from cache_utils import RESULT_CACHE
+from graph_utils import (get_compact_graph_path, get_exact_index_path,
+                         get_pdb_path, load_compact_graph)
+from models import MonoWeigthQuery, MultiMonoWeightQuery
 from models_utils import load_model
 from prot_graph_exception import ProtGraphException
+from query_weight import parallel
+from query_weight.exact_index import get_integer_resolution
+from query_weight.k_tuner import get_k
+from request_metrics import phase
 
+# The algorithms return the paths and their (integer) weights
 ALGORITHMS = dict(
         top_sort=qa.top_sort_query,
         bfs_fifo=qa.bfs_fifo,
-        bfs_filo=qa.bfs_fifo,
+        bfs_filo=qa.bfs_filo,
         dfs=qa.dfs,
         top_sort_attrs=qa.top_sort_attrs_query,
-        top_sort_attrs_limit_var=qa.top_sort_attrs_query_limit_variants
+        top_sort_attrs_limit_var=qa.top_sort_attrs_query_limit_variants,
+        bidirectional=qa.bidirectional_query
     )
 
 
@@ -40,6 +45,94 @@ def _check_header(req):
         )
 
 
+def _check_not_modified(req, etag, last_modified):
+    """ Raises a 304 (Not Modified), if the client already has the response (conditional requests) """
+    if req.if_none_match is not None:
+        not_modified = "*" in req.if_none_match or etag in req.if_none_match
+    else:
+        not_modified = req.if_modified_since is not None and req.if_modified_since >= last_modified
+
+    if not_modified:
+        raise falcon.HTTPStatus(
+            falcon.HTTP_304,
+            headers={"ETag": '"{}"'.format(etag), "Last-Modified": falcon.dt_to_http(last_modified)}
+        )
+
+
+def _set_validators(resp, etag, last_modified):
+    """ Set the ETag and Last-Modified headers, so that clients can revalidate responses """
+    resp.set_header("ETag", '"{}"'.format(etag))
+    resp.last_modified = last_modified
+
+
+def _result_size(result):
+    """ The (estimated) memory consumption in bytes of a cached search result """
+    resulting, _, _ = result
+    if isinstance(resulting, int):
+        return 64
+    paths, weights = resulting
+    return 64 + sum(64 + 36 * len(p) for p in paths) + 32 * len(weights)
+
+
+def get_query_interval(weight_factor, mono_weight, mass_tolerance, unit):
+    """ Get the interval of (integer) weights, which is searched for """
+    w = weight_factor*mono_weight
+    if unit == "Da":
+        wf = weight_factor*mass_tolerance
+        return np.array([
+            (w - wf),
+            (w + wf),
+        ])
+    else:  # == "ppm"
+        return np.array([
+            w - (w / 1000000) * mass_tolerance,
+            w + (w / 1000000) * mass_tolerance
+        ])
+
+
+def get_limits(query):
+    """ Get the limits of a query (see query_algorithms._get_limits), limits which are not set are None """
+    return dict(
+        variants=query.limit_variants, miscleavages=query.limit_miscleavages, features=query.limit_features
+    )
+
+
+def get_exact(weight_factor, query):
+    """
+    Get the (integer) resolution and maximum weight of the exact index used by a query (None, if the pdb is used)
+    """
+    if not query.exact:
+        return None
+    return get_integer_resolution(weight_factor, query.resolution)
+
+
+def iter_results(graph, paths, path_weights, weight_factor, chunk_size=1024):
+    """ Yields the results (path, weight and seq) of the retrieved paths one by one (built in chunks) """
+    for c in range(0, len(paths), chunk_size):
+        c_paths = paths[c:c + chunk_size]
+        for path, weight, seq in zip(c_paths, path_weights[c:c + chunk_size], get_seqs(graph, c_paths)):
+            yield dict(path=path, weight=weight / weight_factor, seq=seq)
+
+
+def stream_results(results, time, truncated):
+    """ Generator for a streamed NDJSON response. The last line contains the time and if the search was truncated """
+    for r in results:
+        yield (json.dumps(r, ensure_ascii=False) + "\n").encode()
+    yield (json.dumps(dict(time=time, truncated=truncated)) + "\n").encode()
+
+
+def get_seqs(graph, paths):
+    """ Get the sequences of the retrieved paths (gathered at once from the residues of the compact graph) """
+    if len(paths) == 0:
+        return []
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(path) for path in paths])
+    residues = graph.residues[np.fromiter((n for path in paths for n in path), dtype=np.int64, count=offsets[-1])]
+
+    residues = residues.tolist()
+    return ["".join(residues[lo:hi]) for lo, hi in zip(offsets.tolist(), offsets[1:].tolist())]
+
+
 class QueryWeight(object):
     """ This is a generic class, utilizing the method, which generate paths from qeight queries. """
 
@@ -47,160 +140,237 @@ class QueryWeight(object):
         self.base_dir = base_dir
         self.weight_factor = weight_factor
         self.method = method
-        self.mass_dict = _get_mass_dict(factor=self.weight_factor)
 
-    def _return_content(self, resp, peptides, peptide_weights, peptide_seqs, time):
-        """ Return the content. Speicifically Peptide -Path, -Weight and -Sequence. """
+    def _return_content(self, resp, graph, peptides, time, truncated, stream=False):
+        """
+        Return the content. Speicifically Peptide -Path, -Weight and -Sequence (peptides are the paths and weights).
+        If the search was aborted (timeout), only the paths found so far are returned and truncated is set.
+        """
+        # The results are serialized one by one if streamed
+        results = iter_results(graph, *peptides, self.weight_factor)
+        if stream:
+            resp.set_header("content-type", "application/x-ndjson")
+            resp.stream = stream_results(results, time, truncated)
+            return
+
         # Generate returning dict
         return_dict = dict(
-            time=time
+            time=time,
+            truncated=truncated
         )
         # Returning the paths for the peptide
-        return_dict["results"] = [
-            dict(path=p, weight=w, seq=s)
-            for p, w, s in zip(peptides, peptide_weights, peptide_seqs)
-        ]
+        with phase("materialize"):
+            return_dict["results"] = list(results)
 
         resp.set_header("content-type", "application/json")
-        resp.body = json.dumps(return_dict, ensure_ascii=False)
+        with phase("serialize"):
+            resp.body = json.dumps(return_dict, ensure_ascii=False)
 
-    def _execute_query(self, query, accession):
-        """ executes the weight query and gathers other information """
-        # Get Protein depending on accession and path
-        prot_graph_path = get_graph_path(self.base_dir, accession)
+    def _return_count(self, resp, graph, count, time, truncated):
+        """ Return the number of matching peptides. If the search was aborted, this is a lower bound. """
+        resp.set_header("content-type", "application/json")
+        with phase("serialize"):
+            resp.body = json.dumps(dict(time=time, truncated=truncated, count=count))
+
+    def _get_validators(self, query, accession):
+        """
+        Returns the key of a query in the result cache (independent of k or the exact index, the timeout and the
+        response format),
+        the path of the graph (results are validated against it) and the ETag and Last-Modified of its response
+        """
+        q_interval = get_query_interval(self.weight_factor, query.mono_weight, query.mass_tolerance, query.unit)
+        key = (
+            "weight", self.base_dir, accession, self.method.__name__, self.weight_factor, query.count,
+            float(q_interval[0]), float(q_interval[1]), tuple(sorted(get_limits(query).items()))
+        )
 
-        # Load graph
-        graph = igraph.read(prot_graph_path)
+        graph_path = get_compact_graph_path(self.base_dir, accession)
+        st = os.stat(graph_path)
+        etag = hashlib.sha1(repr((key, st.st_mtime_ns, st.st_size)).encode()).hexdigest()
+        return key, graph_path, etag, datetime.utcfromtimestamp(int(st.st_mtime))
 
-        # Get pdb if not generate it and get it!
-        n_pdb = get_pdb_path(self.base_dir, accession, graph, query.k)
+    def _execute_query(self, query, accession):
+        """
+        executes the weight query and gathers other information.
+        Complete results (not aborted) are kept in the result cache
+        """
+        key, graph_path, _, _ = self._get_validators(query, accession)
+        resulting_paths, time_taken, expired = RESULT_CACHE.get(
+            key, graph_path, lambda path: self._search(query, accession), size=_result_size,
+            cache_if=lambda result: not result[2]
+        )
+        with phase("graph_load"):
+            graph = load_compact_graph(self.base_dir, accession)
+        return graph, resulting_paths, time_taken, expired
+
+    def _search(self, query, accession):
+        """ searches the paths (or counts them) and measures the time """
+        # Load graph (in its compact form)
+        with phase("graph_load"):
+            graph = load_compact_graph(self.base_dir, accession)
+
+        # Get pdb if not generate it and get it! (of the tuned k, if not set) or the exact index
+        exact = get_exact(self.weight_factor, query)
+        with phase("pdb"):
+            if exact is not None:
+                k, n_pdb = None, get_exact_index_path(self.base_dir, accession, graph, *exact)
+            else:
+                k = get_k(self.base_dir, accession, graph, query.k)
+                n_pdb = get_pdb_path(self.base_dir, accession, graph, k)
 
         # Get intervals
-        w = self.weight_factor*query.mono_weight
-        if query.unit == "Da":
-            wf = self.weight_factor*query.mass_tolerance
-            q_interval = np.array([
-                (w - wf),
-                (w + wf),
-            ])
-        else:  # == "ppm"
-            q_interval = np.array([
-                w - (w / 1000000) * query.mass_tolerance,
-                w + (w / 1000000) * query.mass_tolerance
-            ])
+        q_interval = get_query_interval(self.weight_factor, query.mono_weight, query.mass_tolerance, query.unit)
 
         # Set start and end node
-        start, end = get_start_and_end_node(graph)
+        start, end = graph.start, graph.end
 
-        # Execute and measure time  TODO measure time
-        resulting_paths = []
+        # Execute and measure time. The algorithm stops on its own once the deadline has passed
+        deadline = qa.Deadline(query.timeout)
+        limits = get_limits(query)
 
-        def _async_raise(tid, exctype):
-            '''Raises an exception in the threads with id tid'''
-            if not inspect.isclass(exctype):
-                raise TypeError("Only types can be raised (not instances)")
-            res = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(tid), ctypes.py_object(exctype))
-            if res == 0:
-                raise ValueError("invalid thread id")
-            elif res != 1:
-                # "if it returns a number greater than one, you're in trouble,
-                # and you should call it again with exc=NULL to revert the effect"
-                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(tid), None)
-                raise SystemError("PyThreadState_SetAsyncExc failed")
+        # STAR MEASURING HERE!
+        starttime = timeit.default_timer()
+        with phase("traversal"):
+            if query.count:
+                # Only count the paths (independent of the algorithm)
+                resulting_paths = qa.count_query(
+                    start, end, q_interval, graph, n_pdb, _deadline=deadline, _limits=limits
+                )
+            elif query.parallel:
+                # Split the search space and execute it in the process pool
+                resulting_paths = parallel.execute_parallel(
+                    self.base_dir, accession, self.method, q_interval, k, deadline, graph, n_pdb, limits, exact
+                )
+            else:
+                resulting_paths = self.method(
+                    start, end, q_interval, graph, n_pdb, _deadline=deadline, _limits=limits
+                )
+        time_taken = timeit.default_timer() - starttime
+        # STOP MEASURING HERE!
 
-        class ThreadWithExc(threading.Thread):
+        return resulting_paths, time_taken, deadline.expired
 
-            def __init__(self, method):
-                super().__init__()
-                self.method = method
+    def _respond(self, req, resp, query, accession, conditional=False):
+        """
+        Respond to a query. If conditional (only for GET), the response can be revalidated
+        (or is answered with 304 if the client already has it)
+        """
+        if conditional:
+            _, _, etag, last_modified = self._get_validators(query, accession)
+            _check_not_modified(req, etag, last_modified)
 
-            def run(self):
-                try:
-                    resulting_paths.extend(self.method(start, end, q_interval, graph, n_pdb))
-                finally:
-                    pass
+        # Get peptides
+        results = self._execute_query(query, accession)
 
-            def _get_my_tid(self):
-                if not self.isAlive():
-                    raise threading.ThreadError("the thread is not active")
+        # Only complete results can be revalidated
+        if conditional and not results[-1]:
+            _set_validators(resp, etag, last_modified)
 
-                # do we have it cached?
-                if hasattr(self, "_thread_id"):
-                    return self._thread_id
+        # Return the content depending on return type
+        if query.count:
+            self._return_count(resp, *results)
+        else:
+            self._return_content(resp, *results, stream=query.stream)
 
-                # no, look for it in the _active dict
-                for tid, tobj in threading._active.items():
-                    if tobj is self:
-                        self._thread_id = tid
-                        return tid
+    def on_get(self, req, resp, accession):
+        # Load Query
+        query = load_model(MonoWeigthQuery, req.params)
 
-                raise AssertionError("could not determine the thread's id")
+        self._respond(req, resp, query, accession, conditional=True)
 
-            def raiseExc(self, exctype):
-                _async_raise(self._get_my_tid(), exctype)
+    def on_post(self, req, resp, accession):
+        # Check headers
+        _check_header(req)
 
-        t = ThreadWithExc(self.method)
+        # Load Query
+        query = load_model(MonoWeigthQuery, req.media)
 
-        # STAR MEASURING HERE!
-        starttime = timeit.default_timer()
-        t.start()
-        t.join(query.timeout)
-        time_taken = timeit.default_timer() - starttime
-        # STOP MEASURING HERE!
+        self._respond(req, resp, query, accession)
 
-        # Set timeout limit
-        if time_taken > query.timeout:
-            time_taken = query.timeout
-
-        # Terminate thread if still running
-        if t.is_alive():
-            while t.isAlive():
-                time.sleep(0.01)
-                try:
-                    t.raiseExc(Exception)
-                except Exception:
-                    pass
-            t.join()
-
-        # Get weights, which were actually retrieved:  (via protgraph)
-        resulting_weights = [
-            sum(
-                [
-                    self.mass_dict[x][0]
-                    for x in "".join(graph.vs[path]["aminoacid"])
-                    .replace("__start__", "")
-                    .replace("__end__", "")
-                ]
-            ) / self.weight_factor
-            for path in resulting_paths
-        ]
 
-        # Get weights, which were actually retrieved:  (via protgraph)
-        resulting_seq = [
-            "".join(graph.vs[path]["aminoacid"])
-            .replace("__start__", "")
-            .replace("__end__", "")
-            for path in resulting_paths
+class QueryWeights(object):
+    """
+    Query for multiple weights (precursors) at once, which are all searched in a single traversal.
+    Each result is tagged with the precursors (their indices) it matches.
+    """
+
+    def __init__(self, base_dir, weight_factor):
+        self.base_dir = base_dir
+        self.weight_factor = weight_factor
+
+    def _return_content(self, resp, peptides, peptide_weights, peptide_seqs, peptide_precursors, time, truncated):
+        """ Return the content. Speicifically Peptide -Path, -Weight, -Sequence and the matched precursors. """
+        # Generate returning dict
+        return_dict = dict(
+            time=time,
+            truncated=truncated
+        )
+        # Returning the paths for the peptide
+        return_dict["results"] = [
+            dict(path=p, weight=w, seq=s, precursors=pre)
+            for p, w, s, pre in zip(peptides, peptide_weights, peptide_seqs, peptide_precursors)
         ]
 
-        return resulting_paths, resulting_weights, resulting_seq, time_taken
+        resp.set_header("content-type", "application/json")
+        with phase("serialize"):
+            resp.body = json.dumps(return_dict, ensure_ascii=False)
+
+    def _get_precursors(self, q_intervals, path_weights):
+        """ Get the indices of the precursors (their intervals) matching each path weight """
+        order = np.argsort(q_intervals[:, 0], kind="stable")
+        lows, highs = q_intervals[order, 0], q_intervals[order, 1]
+        max_width = np.max(highs - lows)
+
+        precursors = []
+        for w in path_weights:
+            # Only intervals starting in [w - max_width, w] can contain w
+            lo, hi = np.searchsorted(lows, w - max_width), np.searchsorted(lows, w, side="right")
+            precursors.append(sorted(order[lo:hi][highs[lo:hi] >= w].tolist()))
+        return precursors
 
-    def on_get(self, req, resp, accession):
-        # Load Query
-        query = load_model(MonoWeigthQuery, req.params)
+    def _execute_query(self, query, accession):
+        """ executes the weight query with multiple weights and gathers other information """
+        # Load graph (in its compact form)
+        with phase("graph_load"):
+            graph = load_compact_graph(self.base_dir, accession)
 
-        # Get peptides
-        results = self._execute_query(query, accession)
+        # Get pdb if not generate it and get it! (of the tuned k, if not set)
+        with phase("pdb"):
+            k = get_k(self.base_dir, accession, graph, query.k)
+            n_pdb = get_pdb_path(self.base_dir, accession, graph, k)
 
-        # Return the content depending on return type
-        self._return_content(resp, *results)
+        # Get intervals (one per precursor)
+        q_intervals = np.array([
+            get_query_interval(self.weight_factor, p.mono_weight, p.mass_tolerance, p.unit)
+            for p in query.precursors
+        ]).reshape(-1, 2)
+
+        # Execute and measure time. The algorithm stops on its own once the deadline has passed
+        deadline = qa.Deadline(query.timeout)
+
+        # STAR MEASURING HERE!
+        starttime = timeit.default_timer()
+        with phase("traversal"):
+            resulting_paths, path_weights = qa.top_sort_attrs_multi_query(
+                graph.start, graph.end, q_intervals, graph, n_pdb, _deadline=deadline, _limits=get_limits(query)
+            )
+        time_taken = timeit.default_timer() - starttime
+        # STOP MEASURING HERE!
+
+        # Get weights and sequences, which were actually retrieved
+        with phase("materialize"):
+            resulting_weights = [w / self.weight_factor for w in path_weights]
+            resulting_seq = get_seqs(graph, resulting_paths)
+            resulting_precursors = self._get_precursors(q_intervals, path_weights)
+
+        return resulting_paths, resulting_weights, resulting_seq, resulting_precursors, time_taken, deadline.expired
 
     def on_post(self, req, resp, accession):
         # Check headers
         _check_header(req)
 
         # Load Query
-        query = load_model(MonoWeigthQuery, req.media)
+        query = load_model(MultiMonoWeightQuery, req.media)
 
         # Get peptides
         results = self._execute_query(query, accession)
@@ -0,0 +1,103 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import query_weight.query_algorithms as qa
+from graph_utils import get_exact_index_path, get_pdb_path, load_compact_graph
+
+# Number of parts per process, in which the search space of a query is split (for load balancing)
+PARTS_PER_PROCESS = 4
+
+_POOL = None
+_POOL_PROCESSES = None
+_POOL_LOCK = threading.Lock()
+
+
+def start_pool(processes):
+    """
+    Starts the process pool, which is shared by all requests. This should be called before serving,
+    so that the workers are forked while no other threads are running. 0 processes disables the pool.
+    """
+    with _POOL_LOCK:
+        _start_pool(processes)
+
+
+def stop_pool():
+    """ Shuts down the process pool (e.g. once a serving process exits), so that no workers are left behind """
+    with _POOL_LOCK:
+        _start_pool(0)
+
+
+def _start_pool(processes):
+    """ Starts the process pool (lock needs to be held) """
+    global _POOL, _POOL_PROCESSES
+    if _POOL is not None:
+        _POOL.shutdown()
+    _POOL, _POOL_PROCESSES = None, processes
+    if processes > 0:
+        _POOL = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork"))
+        # Fork all workers right away
+        for f in [_POOL.submit(int) for _ in range(processes)]:
+            f.result()
+
+
+def get_pool():
+    """ Returns the process pool (started with all cores, if not configured yet) and the number of processes """
+    with _POOL_LOCK:
+        if _POOL_PROCESSES is None:
+            _start_pool(multiprocessing.cpu_count())
+        return _POOL, _POOL_PROCESSES
+
+
+def split_start_edges(graph, parts):
+    """ Split the out-edges (CSR positions) of the start node into (at most) parts many interleaved parts """
+    positions = np.arange(graph.out_offsets[graph.start], graph.out_offsets[graph.start + 1])
+    return [positions[i::parts] for i in range(min(parts, len(positions)))]
+
+
+def execute_parallel(base_dir, accession, method, q_interval, k, deadline, graph, n_pdb, limits=None, exact=None):
+    """
+    Execute a weight query, split by the out-edges of the start node, in the process pool and merge the results.
+    The graph and pdb (or the exact index, if exact is set) need to be loaded (and generated) already,
+    the workers then load them from their cache/disk.
+    Returns the paths and their weights (deadline.expired is set, if any part was aborted).
+    """
+    pool, processes = get_pool()
+    if pool is None:
+        # Parallel execution is disabled, execute it in this process
+        return method(graph.start, graph.end, q_interval, graph, n_pdb, _deadline=deadline, _limits=limits)
+
+    # The deadline is passed as is (the timer is monotonic across processes)
+    futures = [
+        pool.submit(_execute_part, base_dir, accession, method, q_interval, k, deadline.end, part, limits, exact)
+        for part in split_start_edges(graph, PARTS_PER_PROCESS * processes)
+    ]
+
+    # Merge the results (in order of the parts)
+    paths, weights = [], []
+    for f in futures:
+        part_paths, part_weights, part_expired = f.result()
+        paths.extend(part_paths)
+        weights.extend(part_weights)
+        deadline.expired |= part_expired
+
+    return paths, weights
+
+
+def _execute_part(base_dir, accession, method, q_interval, k, deadline_end, start_edges, limits=None, exact=None):
+    """ Executes a part of a query (in a worker process) """
+    graph = load_compact_graph(base_dir, accession)
+    if exact is not None:
+        n_pdb = get_exact_index_path(base_dir, accession, graph, *exact)
+    else:
+        n_pdb = get_pdb_path(base_dir, accession, graph, k)
+    part_graph = graph.with_start_edges(start_edges)
+
+    deadline = qa.Deadline()
+    deadline.end = deadline_end
+    paths, weights = method(
+        part_graph.start, part_graph.end, q_interval, part_graph, n_pdb, _deadline=deadline, _limits=limits
+    )
+    return paths, weights, deadline.expired
@@ -0,0 +1,87 @@
+import glob
+import os
+import time
+
+import numpy as np
+
+from cache_utils import METADATA_CACHE
+
+
+def _get_index_path(base_dir, k):
+    """ Path of the index of the store for k """
+    return os.path.join(base_dir, "pdb_store.k{}.npz".format(k))
+
+
+class PdbStore(object):
+    """
+    Consolidated (read-only) store of the pdbs of all proteins of a base folder (for one k).
+    The pdbs are kept in a single memory mapped array (shape: num_nodes x k x 2), the pdb of the i-th
+    accession is at offsets[i]:offsets[i+1]. Lookups are zero-copy and the pages are shared
+    (via the page cache) across all processes.
+    """
+
+    def __init__(self, accessions, offsets, data):
+        self.accessions = accessions  # sorted
+        self.offsets = offsets
+        self.data = data
+
+    @property
+    def nbytes(self):
+        """ The (estimated) memory consumption in bytes (the memory mapped data is not counted) """
+        return self.accessions.nbytes + self.offsets.nbytes
+
+    def get(self, accession):
+        """ Returns the pdb of accession (a read-only view) or None, if it is not in the store """
+        idx = np.searchsorted(self.accessions, accession)
+        if idx == len(self.accessions) or self.accessions[idx] != accession:
+            return None
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]]
+
+
+def save_pdb_store(base_dir, k, accessions, pdb_files):
+    """
+    Consolidate the pdb files (of k) of the accessions into a store. A new data file is written first,
+    then the index pointing to it is replaced atomically, so running servers never see a partial store.
+    Old data files are removed afterwards.
+    """
+    order = np.argsort(np.array(accessions, dtype=str), kind="stable")
+    accessions = np.array(accessions, dtype=str)[order]
+    pdb_files = [pdb_files[i] for i in order]
+
+    # Get the number of nodes of each protein (without reading the pdbs)
+    offsets = np.zeros(len(pdb_files) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([np.load(f, mmap_mode="r").shape[0] for f in pdb_files])
+
+    # Copy the pdbs into the data file
+    data_file = "pdb_store.k{}.{}.npy".format(k, time.time_ns())
+    data = np.lib.format.open_memmap(
+        os.path.join(base_dir, data_file), mode="w+", dtype=np.float64, shape=(int(offsets[-1]), k, 2)
+    )
+    for f, lo, hi in zip(pdb_files, offsets, offsets[1:]):
+        data[lo:hi] = np.load(f)
+    data.flush()
+    del data
+
+    # Replace the index (graph_utils imports this module, so it is imported here)
+    from graph_utils import save_atomically
+    save_atomically(
+        _get_index_path(base_dir, k), lambda f: np.savez(f, accessions=accessions, offsets=offsets, data_file=data_file)
+    )
+
+    for old_file in glob.glob(os.path.join(base_dir, "pdb_store.k{}.*.npy".format(k))):
+        if os.path.basename(old_file) != data_file:
+            os.remove(old_file)
+
+
+def load_pdb_store(base_dir, k):
+    """ Load the store of k (kept in the cache). Returns None, if it was not built """
+    path = _get_index_path(base_dir, k)
+    if not os.path.isfile(path):
+        return None
+
+    def _load(path):
+        with np.load(path) as npz:
+            data = np.load(os.path.join(base_dir, str(npz["data_file"])), mmap_mode="r")
+            return PdbStore(npz["accessions"], npz["offsets"], data)
+
+    return METADATA_CACHE.get(("pdb_store", base_dir, k), path, _load, size=lambda store: store.nbytes)
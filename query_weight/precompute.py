@@ -0,0 +1,164 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+
+from graph_utils import (LAYOUTS, get_binary_graph_file, get_binary_graph_path,
+                         get_exact_index_file, get_graph_path, get_pdb_file,
+                         get_pdb_path, get_top_sort_path, iter_accessions,
+                         read_graph, save_atomically, set_layout)
+from query_weight.compact_graph import CompactGraph
+from query_weight.exact_index import build_exact_index, get_integer_resolution
+from query_weight.k_tuner import get_tuned_k_file, save_tuned_k
+from query_weight.mass_index import (build_mass_index, print_progress,
+                                     save_mass_index)
+from query_weight.pdb_store import save_pdb_store
+
+
+def precompute_protein(base_dir, accession, ks, binary=False, tune=False, exact=()):
+    """
+    Builds the attribute ordered top. sort and the pdbs (for each k) of a protein, if not present.
+    The exact indices are built for each (integer) resolution and maximum weight in exact, if not present.
+    If binary is set, the compact graph is also exported into the binary format (if not present or outdated).
+    If tune is set, k is also tuned for the protein (if not present).
+    The graph is not put into the graph cache, since it is only needed once. The pdb store is not used,
+    since it is (re)built from the pdb files.
+    """
+    graph = CompactGraph.from_graph(read_graph(base_dir, accession, get_graph_path(base_dir, accession)))
+    graph.attrs_top_sort = get_top_sort_path(base_dir, accession, graph)
+    for k in ks:
+        get_pdb_path(base_dir, accession, graph, k, use_store=False)
+    for resolution, max_weight in exact:
+        path = get_exact_index_file(base_dir, accession, resolution)
+        if not os.path.isfile(path):
+            save_atomically(path, build_exact_index(graph, resolution, max_weight).save)
+    if binary and get_binary_graph_path(base_dir, accession) is None:
+        save_atomically(get_binary_graph_file(base_dir, accession), graph.save)
+    if tune and not os.path.isfile(get_tuned_k_file(base_dir, accession)):
+        save_tuned_k(base_dir, accession, graph)
+    return accession
+
+
+def _try_precompute_protein(base_dir, accession, *args):
+    """ Precomputes a protein (in a worker process). Returns the accession and the error, if it failed (else None) """
+    try:
+        precompute_protein(base_dir, accession, *args)
+        return accession, None
+    except Exception as ex:
+        return accession, "{}: {}".format(type(ex).__name__, ex)
+
+
+def precompute(base_dir, ks, processes, binary=False, tune=False, exact=()):
+    """
+    Precompute the top. sorts and pdbs of all proteins in base_dir in a process pool, reporting the progress.
+    Proteins which fail (e.g. on a truncated graph file) are reported and skipped. Returns their accessions
+    """
+    accessions = list(iter_accessions(base_dir))
+    starttime = timeit.default_timer()
+
+    failed = []
+    try:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork")) as pool:
+            results = pool.map(
+                _try_precompute_protein, [base_dir]*len(accessions), accessions, [ks]*len(accessions),
+                [binary]*len(accessions), [tune]*len(accessions), [exact]*len(accessions),
+                chunksize=max(1, len(accessions) // (16 * processes))
+            )
+            for idx, (accession, error) in enumerate(results, start=1):
+                if error is not None:
+                    failed.append(accession)
+                    print("\rFailed {}: {}".format(accession, error), file=sys.stderr)
+                print(
+                    "\r{}/{} proteins ({}), {:.1f}s".format(
+                        idx, len(accessions), accession, timeit.default_timer() - starttime
+                    ),
+                    end="", file=sys.stderr, flush=True
+                )
+    finally:
+        print(file=sys.stderr)
+    if failed:
+        print("{} proteins failed: {}".format(len(failed), ", ".join(failed)), file=sys.stderr)
+    return failed
+
+
+def build_pdb_store(base_dir, k):
+    """
+    Consolidate the pdb files (of k) of all proteins in base_dir into the memory mapped pdb store.
+    Proteins without a pdb file (e.g. which failed in precompute) are left out
+    """
+    accessions = [x for x in iter_accessions(base_dir) if os.path.isfile(get_pdb_file(base_dir, x, k))]
+    save_pdb_store(base_dir, k, accessions, [get_pdb_file(base_dir, accession, k) for accession in accessions])
+    print("Built the pdb store for k={} ({} proteins)".format(k, len(accessions)), file=sys.stderr)
+
+
+def parse_args():
+    # Arguments for Parser
+    parser = argparse.ArgumentParser(
+        description="Precompute the pdbs (for one or more k) and top. sorts of all proteins in a base folder, "
+        "so that weight queries do not need to build them on their first request"
+    )
+    parser.add_argument(
+        "base_folder", type=str,
+        help="The base folder containing the generated exported graph files, which can be read by igraph."
+    )
+    parser.add_argument(
+        "--layout", "-l", type=str, default="nested", choices=LAYOUTS,
+        help="The layout of the base folder: 'nested' (graphs exported with '-edirs'), 'flat' (graphs exported "
+        "without '-edirs') or 'packed' (graphs packed into an archive via pack_graphs.py). Default is 'nested'."
+    )
+    parser.add_argument(
+        "--k", "-k", type=int, nargs="+", default=[10],
+        help="The number of intervals of the pdbs (multiple values can be given). The default is set to 10."
+    )
+    parser.add_argument(
+        "--num_of_processes", "-np", type=int, default=multiprocessing.cpu_count(),
+        help="The number of processes used to precompute. Default is set to the number of cores."
+    )
+    parser.add_argument(
+        "--mass_index", "-mi", default=False, action="store_true",
+        help="Set this flag to also (re)build the mass index afterwards (using the first k)."
+    )
+    parser.add_argument(
+        "--binary", "-b", default=False, action="store_true",
+        help="Set this flag to also export the graphs into a binary (columnar) format, which is loaded "
+        "(much faster than the pickled graphs) by the weight queries."
+    )
+    parser.add_argument(
+        "--tune_k", "-tk", default=False, action="store_true",
+        help="Set this flag to also tune k for each protein (via sampled queries), which is used by weight queries "
+        "without k. Otherwise they use k=10."
+    )
+    parser.add_argument(
+        "--exact_resolution", "-er", type=float, nargs="+", default=[],
+        help="Also build the exact index (used by weight queries with 'exact' set) for each of these resolutions "
+        "(in Da, e.g. 0.01). By default it is built on the first such query of a protein."
+    )
+    parser.add_argument(
+        "--mass_dict_factor", "-mdf", type=float, default=1000000000,
+        help="Set the factor for the masses which was used to generate the graphs (to convert the resolutions). "
+        "The default is set to 1 000 000 000."
+    )
+    parser.add_argument(
+        "--pdb_store", "-ps", default=False, action="store_true",
+        help="Set this flag to also (re)build the consolidated pdb store (for each k) afterwards, which is "
+        "memory mapped and shared by all server processes."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_layout(args.layout)
+    failed = precompute(
+        args.base_folder, args.k, args.num_of_processes, args.binary, args.tune_k,
+        [get_integer_resolution(args.mass_dict_factor, x) for x in args.exact_resolution]
+    )
+    if args.pdb_store:
+        for k in args.k:
+            build_pdb_store(args.base_folder, k)
+    if args.mass_index:
+        save_mass_index(args.base_folder, build_mass_index(args.base_folder, args.k[0], print_progress, failed))
+        print(file=sys.stderr)
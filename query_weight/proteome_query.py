@@ -0,0 +1,158 @@
+import json
+import timeit
+from concurrent.futures import as_completed
+
+import falcon
+
+import query_weight.query_algorithms as qa
+from graph_utils import (get_exact_index_path, get_graph_path, get_pdb_path,
+                         iter_accessions, load_compact_graph)
+from models import ProteomeWeightQuery
+from models_utils import load_model
+from query_weight import parallel
+from query_weight.k_tuner import get_k
+from query_weight.mass_index import load_mass_index
+from query_weight.mono_weight_query import (ALGORITHMS, _check_header,
+                                            get_exact, get_limits,
+                                            get_query_interval, iter_results)
+from request_metrics import phase
+
+
+def _query_protein(
+    base_dir, accession, method, q_interval, k, deadline_end, weight_factor, limits=None, exact=None, count=False
+):
+    """
+    Executes a weight query on one protein (in a worker process). If k is None, the tuned k (or 10) is used.
+    If exact (the resolution and maximum weight) is set, the exact index is used instead of the pdb.
+    Returns the results (path, weight and seq) or, if count is set, the number of matching peptides
+    and whether the search was aborted.
+    """
+    deadline = qa.Deadline()
+    deadline.end = deadline_end
+    if deadline.check():
+        return 0 if count else [], True
+
+    graph = load_compact_graph(base_dir, accession)
+    if exact is not None:
+        n_pdb = get_exact_index_path(base_dir, accession, graph, *exact)
+    else:
+        n_pdb = get_pdb_path(base_dir, accession, graph, get_k(base_dir, accession, graph, k))
+    if count:
+        # Only count the paths (independent of the algorithm)
+        num = qa.count_query(graph.start, graph.end, q_interval, graph, n_pdb, _deadline=deadline, _limits=limits)
+        return num, deadline.expired
+    paths, weights = method(graph.start, graph.end, q_interval, graph, n_pdb, _deadline=deadline, _limits=limits)
+    return list(iter_results(graph, paths, weights, weight_factor)), deadline.expired
+
+
+class QueryWeightProteome(object):
+    """
+    Executes a weight query over all proteins in base_dir (or over the given accessions).
+    The proteins are searched in the process pool, the matches are streamed back (as NDJSON) as they are found.
+    """
+
+    def __init__(self, base_dir, weight_factor):
+        self.base_dir = base_dir
+        self.weight_factor = weight_factor
+
+    def _get_accessions(self, query, q_interval):
+        """ Get the accessions, which should be searched. Proteins which cannot match are skipped (via mass index) """
+        accessions = query.accessions if len(query.accessions) != 0 else list(iter_accessions(self.base_dir))
+
+        mass_index = load_mass_index(self.base_dir)
+        if mass_index is not None:
+            return mass_index.filter(accessions, q_interval), len(accessions)
+        return accessions, len(accessions)
+
+    def _iter_protein_results(self, query, accessions, q_interval, deadline):
+        """ Yields the results (accession, results, expired) per protein, as soon as they are available """
+        method = ALGORITHMS[query.algorithm]
+        args = (
+            q_interval, query.k, deadline.end, self.weight_factor, get_limits(query),
+            get_exact(self.weight_factor, query), query.count
+        )
+
+        pool, _ = parallel.get_pool()
+        if pool is None:
+            # Parallel execution is disabled, execute it in this process
+            for accession in accessions:
+                yield (accession, *_query_protein(self.base_dir, accession, method, *args))
+            return
+
+        futures = {pool.submit(_query_protein, self.base_dir, acc, method, *args): acc for acc in accessions}
+        try:
+            for f in as_completed(futures):
+                yield (futures[f], *f.result())
+        finally:
+            # E.G. the client disconnected, we do not need the remaining results
+            for f in futures:
+                f.cancel()
+
+    def _stream_results(self, query, q_interval):
+        """
+        Generator for the NDJSON response (one line per peptide or, if count is set, per protein with matches).
+        The last line contains the time and if the search was truncated
+        """
+        deadline = qa.Deadline(query.timeout)
+        starttime = timeit.default_timer()
+        with phase("mass_index"):
+            accessions, num_proteins = self._get_accessions(query, q_interval)
+
+        num_results = 0
+        protein_results = self._iter_protein_results(query, accessions, q_interval, deadline)
+        while True:
+            # Wait for the next protein
+            with phase("traversal"):
+                entry = next(protein_results, None)
+            if entry is None:
+                break
+
+            accession, results, expired = entry
+            deadline.expired |= expired
+            if query.count:
+                if results != 0:
+                    num_results += results
+                    yield (json.dumps(dict(accession=accession, count=results)) + "\n").encode()
+                continue
+            for r in results:
+                num_results += 1
+                with phase("serialize"):
+                    line = (json.dumps(dict(accession=accession, **r), ensure_ascii=False) + "\n").encode()
+                yield line
+
+        yield (json.dumps(dict(
+            time=timeit.default_timer() - starttime,
+            truncated=deadline.expired,
+            proteins=num_proteins,
+            skipped=num_proteins - len(accessions),
+            results=num_results
+        )) + "\n").encode()
+
+    def _check_accessions(self, query):
+        """ Checks the given accessions (raises 404 if invalid or not existing), before the response is streamed """
+        for accession in query.accessions:
+            get_graph_path(self.base_dir, accession)
+
+    def _return_content(self, resp, query):
+        self._check_accessions(query)
+        q_interval = get_query_interval(self.weight_factor, query.mono_weight, query.mass_tolerance, query.unit)
+        resp.set_header("content-type", "application/x-ndjson")
+        resp.stream = self._stream_results(query, q_interval)
+        resp.status = falcon.HTTP_200
+
+    def on_get(self, req, resp):
+        # Load Query
+        query = load_model(ProteomeWeightQuery, req.params)
+
+        # Return the (streamed) content
+        self._return_content(resp, query)
+
+    def on_post(self, req, resp):
+        # Check headers
+        _check_header(req)
+
+        # Load Query
+        query = load_model(ProteomeWeightQuery, req.media)
+
+        # Return the (streamed) content
+        self._return_content(resp, query)
@@ -1,12 +1,109 @@
+import heapq
+import timeit
 from collections import defaultdict, deque
 
 import numpy as np
 
 from protgraph.graph_collapse_edges import Or
 
-def _shift_interval_by(intervals, weight):
-    """ Shift the intervals by weight """
-    return [[x + weight, y + weight] for [x, y] in intervals]
+# Number of paths, which are expanded at once (vectorized) in the top. sort traversals
+_CHUNK_SIZE = 65536
+
+# The counts (per edge, columns of the compact graph), which can be limited in a query (see _limits)
+LIMIT_COLUMNS = dict(
+    variants="variant_counts",  # VARIANT qualifiers
+    miscleavages="miscleavage_counts",  # Missed cleavages (cleaved edges)
+    features="feature_counts"  # Other qualifiers (MUTAGEN, CONFLICT, SIGNAL, ..., but not VAR_SEQ)
+)
+
+# Minimum count of nodes, which cannot be reached (large, but cannot overflow if added up)
+_UNREACHABLE = np.iinfo(np.int64).max // 4
+
+
+class Deadline(object):
+    """
+    Deadline for a query, which is checked cooperatively in the main loops of the algorithms.
+    If it has passed, the algorithms stop and return the paths found so far (expired is then set).
+    """
+
+    def __init__(self, timeout=None):
+        self.end = None if timeout is None else timeit.default_timer() + timeout
+        self.expired = False
+
+    def check(self):
+        """ Returns True if the deadline has passed """
+        if not self.expired and self.end is not None and timeit.default_timer() > self.end:
+            self.expired = True
+        return self.expired
+
+
+class SearchStats(object):
+    """
+    Counters of a search: expansions (partial paths, which were extended), prunes (extensions discarded via
+    the pdb) and max_frontier (maximum number of partial paths kept at once, e.g. in the queue)
+    """
+
+    def __init__(self):
+        self.expansions = 0
+        self.prunes = 0
+        self.max_frontier = 0
+        self._frontier = 0
+
+    def expand(self, expanded, pruned):
+        """ Count the extensions of partial paths, which were kept (expanded) or discarded (pruned) """
+        self.expansions += expanded
+        self.prunes += pruned
+
+    def push(self, count):
+        """ count many partial paths were added to the frontier """
+        self._frontier += count
+        self.max_frontier = max(self.max_frontier, self._frontier)
+
+    def pop(self, count):
+        """ count many partial paths were removed from the frontier """
+        self._frontier -= count
+
+    def as_dict(self):
+        return dict(expansions=self.expansions, prunes=self.prunes, max_frontier=self.max_frontier)
+
+
+class _PathTable(object):
+    """
+    Array-backed parent-pointer table, in which paths share their prefixes (a trie).
+    Each entry holds a node and the entry of its predecessor on the path (-1 for the first node).
+    Full paths are only reconstructed for the entries, which reached the end.
+    """
+
+    def __init__(self, capacity=1024):
+        self.nodes = np.empty(capacity, dtype=np.int64)
+        self.parents = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    def add(self, parents, nodes):
+        """ Add entries (parents and nodes are broadcasted). Returns the ids of the new entries """
+        parents, nodes = np.broadcast_arrays(parents, nodes)
+        count = parents.size
+        if self.size + count > len(self.nodes):
+            capacity = max(2 * len(self.nodes), self.size + count)
+            self.nodes = np.concatenate((self.nodes[:self.size], np.empty(capacity - self.size, dtype=np.int64)))
+            self.parents = np.concatenate((self.parents[:self.size], np.empty(capacity - self.size, dtype=np.int64)))
+
+        self.nodes[self.size:self.size + count] = nodes.reshape(-1)
+        self.parents[self.size:self.size + count] = parents.reshape(-1)
+        self.size += count
+        return np.arange(self.size - count, self.size, dtype=np.int64)
+
+    def paths(self, ids):
+        """ Reconstruct the paths ending in the entries ids """
+        nodes, parents = self.nodes[:self.size].tolist(), self.parents[:self.size].tolist()
+        paths = []
+        for i in ids:
+            path = []
+            while i != -1:
+                path.append(nodes[i])
+                i = parents[i]
+            paths.append(path[::-1])
+        return paths
 
 
 def _merge_overlapping_intervals(intervals):
@@ -21,15 +118,6 @@ def _merge_overlapping_intervals(intervals):
     return [list(x) for x in np.vstack((starts[:][valid[:-1]], ends[:][valid[1:]])).T]
 
 
-def _merge_closest_intervals(intervals):
-    """ Get the closest interval and merge those two """
-    diff = [y[0]-x[1] for x, y in zip(intervals, intervals[1:])]
-    argmin = diff.index(min(diff))
-
-    new_interval = [intervals[argmin][0], intervals[argmin+1][1]]
-    return intervals[:argmin] + [new_interval] + intervals[argmin+2:]
-
-
 def build_pdb(graph, k=5):
     """
     Generates the pdb (intervals). Each node will have up to k many intervals
@@ -37,333 +125,723 @@ def build_pdb(graph, k=5):
     If too many intervals are present the closest ones will be merged.
 
     This uses the mono_weight, but could be extended to use the avrg_weight (TODO DL?)
+
+    Returns the intervals of all nodes as matrix (shape: n x k x 2, filled with nans).
     """
-    rev_top_sort = graph.topological_sorting(mode="IN")
+    return _build_intervals(
+        graph.top_sort[::-1].tolist(), graph.out_offsets, graph.out_targets, graph.out_weights, graph.vcount, k
+    )
 
-    # Initial attribute values:
-    graph.vs[rev_top_sort[0]]["pdb"] = [[0, 0]]
-
-    # iterate
-    for node in rev_top_sort[1:]:
-        intervals = []
-        for out_edge in graph.incident(node, mode="OUT"):
-            intervals.extend(
-                _shift_interval_by(
-                    graph.vs[graph.es[out_edge].target]["pdb"],
-                    graph.es[out_edge]["mono_weight"]
-                )
-            )
-
-        sorted_intervals = _merge_overlapping_intervals(sorted(intervals, key=lambda x: x[0]))
-
-        while True:
-            if len(sorted_intervals) <= k:
-                break
-            else:
-                sorted_intervals = _merge_closest_intervals(sorted_intervals)
 
-        graph.vs[node]["pdb"] = sorted_intervals
+def build_forward_pdb(graph, k=5):
+    """
+    Generates the forward pdb (intervals of the weights from the start node to each node).
+    It is built like the pdb, but via the top. sort and the in-edges.
+
+    Returns the intervals of all nodes as matrix (shape: n x k x 2, only nans if a node is not reachable).
+    """
+    in_offsets, in_sources, in_weights = _get_in_edges(graph)
+    return _build_intervals(graph.top_sort.tolist(), in_offsets, in_sources, in_weights, graph.vcount, k)
 
 
-def dfs(start, stop, tv_interval, _graph, _n_pdb):
-    """ Depth First Search of the Graph """
-    return _dfs_inner([start.index], stop.index, tv_interval, _graph, _n_pdb)
+def _get_in_edges(graph, column="out_weights"):
+    """ Returns the in-edges of the graph in CSR form (in_offsets, in_sources and the values of an edge column) """
+    order = np.argsort(graph.out_targets, kind="stable")
+    in_offsets = np.zeros(graph.vcount + 1, dtype=np.int64)
+    in_offsets[1:] = np.cumsum(np.bincount(graph.out_targets, minlength=graph.vcount))
+    sources = np.repeat(np.arange(graph.vcount, dtype=np.int64), np.diff(graph.out_offsets))
+    return in_offsets, sources[order], getattr(graph, column)[order]
 
 
-def _dfs_inner(path, stop, tv, _graph, _n_pdb):
-    """ Recursive inner method """
-    p = []
+def build_min_counts(graph, column, forward=False):
+    """
+    Generates the minimum sum of a count column (e.g. variant_counts) over the edges of any path from each node
+    to the end node (or from the start node to each node, if forward). Like the pdb, it is built via the rev.
+    top. sort (or the top. sort and the in-edges). Nodes, which are not connected, are set to _UNREACHABLE.
+    """
+    if forward:
+        in_offsets, in_sources, in_counts = _get_in_edges(graph, column)
+        return _build_min_counts(graph.top_sort.tolist(), in_offsets, in_sources, in_counts, graph.vcount)
+    return _build_min_counts(
+        graph.top_sort[::-1].tolist(), graph.out_offsets, graph.out_targets, getattr(graph, column), graph.vcount
+    )
+
+
+def _build_min_counts(order, offsets, neighbors, counts, vcount):
+    """ Builds the minimum counts in the given order (like _build_intervals). The first node is set to 0 """
+    offsets, neighbors, counts = offsets.tolist(), neighbors.tolist(), counts.tolist()
+    min_counts = [_UNREACHABLE]*vcount
+    min_counts[order[0]] = 0
+    for node in order[1:]:
+        for edge in range(offsets[node], offsets[node + 1]):
+            count = counts[edge] + min_counts[neighbors[edge]]
+            if count < min_counts[node]:
+                min_counts[node] = count
+    return np.minimum(np.array(min_counts, dtype=np.int64), _UNREACHABLE)
+
+
+def _get_limits(_graph, _limits, forward=False):
+    """
+    Returns the counts per edge (shape: e x l), the minimum counts to the end (or from the start, if forward)
+    per node (shape: n x l) and the values (l) of the limits, which are set in _limits (e.g. dict(variants=1)).
+    The minimum counts are built on demand and kept in the graph.
+    """
+    names = sorted(x for x, y in (_limits or dict()).items() if y is not None)
+    for name in names:
+        if (name, forward) not in _graph.min_counts:
+            _graph.min_counts[(name, forward)] = build_min_counts(_graph, LIMIT_COLUMNS[name], forward)
 
-    if path[-1] == stop:
-        return [path]
+    edge_counts = np.zeros((_graph.ecount, len(names)), dtype=np.int64)
+    min_counts = np.zeros((_graph.vcount, len(names)), dtype=np.int64)
+    for idx, name in enumerate(names):
+        edge_counts[:, idx] = getattr(_graph, LIMIT_COLUMNS[name])
+        min_counts[:, idx] = _graph.min_counts[(name, forward)]
+    return edge_counts, min_counts, np.array([_limits[x] for x in names], dtype=np.int64)
 
-    for out_edge in _graph.es.select(_source=path[-1]):
-        t_path = path + [out_edge.target]
-        edges = _graph.get_eids(path=t_path)
-        val_f = _func_dist(_n_pdb[out_edge.target, :], tv - sum(_graph.es[edges]["mono_weight"]))
-        if val_f:
-            p.extend(_dfs_inner(t_path, stop, tv, _graph, _n_pdb))
 
-    return p
+def _within_limits(achieved_counts, min_counts, limits):
+    """ Checks if paths with the achieved counts (shape: ... x l) can still reach the end within the limits """
+    return np.all(achieved_counts + min_counts <= limits, axis=-1)
 
 
-def bfs_filo(start, stop, tv_interval, _graph, _n_pdb):
-    """ Breadth-First-Search using a FILO approach. """
-    queue = deque()
-    queue.append([start.index, [], 0])
-    paths = []
+def _build_intervals(order, offsets, neighbors, weights, vcount, k):
+    """
+    Builds up to k intervals per node in the given order, where each node merges the (shifted) intervals
+    of its neighbors (offsets, neighbors and weights in CSR form). The first node is initialized with [0, 0].
+    Returns the matrix of intervals (shape: vcount x k x 2, filled with nans).
 
-    while queue:
-        cur_node, how_to_get, sum_weight = queue.pop()  # This is changed!
+    The nodes are processed in levels (all neighbors of a level are in the previous levels), each level at once.
+    Nodes with only one neighbor have its intervals shifted by the weight, so they are set (after the level of
+    the first node in their chain with more neighbors, their root) from the intervals of their root at once.
+    """
+    pdb = np.full((vcount, k, 2), np.nan)
 
-        if cur_node == stop.index:
-            paths.append([*how_to_get, cur_node])
-            continue
+    # Initial attribute values:
+    pdb[order[0], 0] = [0, 0]
 
-        edges = _graph.es.select(_source=cur_node)
-        eids = [e.index for e in edges]
+    levels, roots, shifts = _get_levels(order, offsets, neighbors, weights, vcount)
+    for level, (merge_nodes, shift_nodes) in enumerate(levels):
+        if level != 0 and len(merge_nodes) != 0:
+            _merge_level(pdb, np.array(merge_nodes, dtype=np.int64), offsets, neighbors, weights, k)
+        if len(shift_nodes) != 0:
+            shift_nodes = np.array(shift_nodes, dtype=np.int64)
+            pdb[shift_nodes] = pdb[roots[shift_nodes]] + shifts[shift_nodes, None, None]
 
-        targeted_nodes = [e.target for e in edges]
-        achieved_tvs = [_graph.es[e]["mono_weight"] + sum_weight for e in eids]
-        val_fs = [
-            _func_dist(_n_pdb[out_edge.target, :], tv_interval - g_pre)
-            for out_edge, g_pre in zip(edges, achieved_tvs)
-        ]
+    return pdb
 
-        pruned_targeted_nodes = [tn for tn, val_f in zip(targeted_nodes, val_fs) if val_f]
-        pruned_achieved_tvs = [tv for tv, val_f in zip(achieved_tvs, val_fs) if val_f]
 
-        for x, y in zip(pruned_targeted_nodes, pruned_achieved_tvs):
-            queue.append([x, how_to_get + [cur_node], y])
+def _get_levels(order, offsets, neighbors, weights, vcount):
+    """
+    Groups the nodes into levels, where nodes with more than one neighbor (merge nodes) are at 1 + the maximum
+    level of their neighbors. Nodes with one neighbor (shift nodes) are at the level of their neighbor.
+    Returns the levels (merge and shift nodes, the first node and nodes without neighbors are at level 0)
+    and the roots and summed up weights (shifts) of the shift nodes.
+    """
+    offsets, neighbors, weights = offsets.tolist(), neighbors.tolist(), weights.tolist()
+    node_levels, roots, shifts = [0]*vcount, list(range(vcount)), [0]*vcount
+    levels = [([order[0]], [])]
+    for node in order[1:]:
+        lo, hi = offsets[node], offsets[node + 1]
+        if hi - lo == 1:
+            neighbor = neighbors[lo]
+            level = node_levels[neighbor]
+            roots[node], shifts[node] = roots[neighbor], shifts[neighbor] + weights[lo]
+        else:
+            level = 1 + max((node_levels[neighbors[e]] for e in range(lo, hi)), default=-1)
+        node_levels[node] = level
+        if level == len(levels):
+            levels.append(([], []))
+        levels[level][1 if hi - lo == 1 else 0].append(node)
+    return levels, np.array(roots, dtype=np.int64), np.array(shifts, dtype=np.int64)
+
 
-    return paths
+def _merge_level(pdb, nodes, offsets, neighbors, weights, k):
+    """
+    Sets the intervals of the nodes (of one level) in the pdb: The (shifted) intervals of their neighbors are
+    sorted (stable) and overlapping ones are merged. If more than k intervals remain, the closest ones are merged.
+    Since merging two intervals does not change the other gaps, the smallest gaps (the first ones on ties)
+    are merged at once. Rows are the nodes, columns the (shifted) intervals of their neighbors.
+    """
+    degrees = offsets[nodes + 1] - offsets[nodes]
+    rows = np.repeat(np.arange(len(nodes)), degrees)
+    columns = np.arange(len(rows)) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+    edges = offsets[nodes][rows] + columns
+
+    # Gather the shifted intervals of the neighbors (in order of the edges)
+    intervals = np.full((len(nodes), degrees.max(), k, 2), np.nan)
+    intervals[rows, columns] = pdb[neighbors[edges]] + weights[edges][:, None, None]
+    intervals = intervals.reshape(len(nodes), -1, 2)
+
+    # Sort by the starts (missing intervals are moved to the end)
+    starts, ends = intervals[:, :, 0], intervals[:, :, 1]
+    sorting = np.argsort(np.where(np.isnan(starts), np.inf, starts), axis=1, kind="stable")
+    starts, ends = np.take_along_axis(starts, sorting, axis=1), np.take_along_axis(ends, sorting, axis=1)
+    present = ~np.isnan(starts)
+
+    # Merge overlapping intervals: A new interval begins, if it starts at or after the maximum end so far
+    max_ends = np.fmax.accumulate(ends, axis=1)
+    begins = present.copy()
+    begins[:, 1:] &= starts[:, 1:] >= max_ends[:, :-1]
+    finishes = present.copy()
+    finishes[:, :-1] &= begins[:, 1:] | ~present[:, 1:]
+    m_starts, m_ends = _compact(starts, begins), _compact(max_ends, finishes)
+
+    # Merge the closest intervals: Remove the (count - k) smallest gaps
+    counts = begins.sum(axis=1)
+    if counts.max() <= k:
+        pdb[nodes, :, 0], pdb[nodes, :, 1] = m_starts[:, :k], m_ends[:, :k]
+        return
+    gaps = m_starts[:, 1:] - m_ends[:, :-1]
+    order = np.argsort(np.where(np.isnan(gaps), np.inf, gaps), axis=1, kind="stable")
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(gaps.shape[1])[None, :], axis=1)
+    merged = ranks < (counts - k)[:, None]
+
+    m_present = ~np.isnan(m_starts)
+    begins = m_present.copy()
+    begins[:, 1:] &= ~merged
+    finishes = m_present.copy()
+    finishes[:, :-1] &= ~merged | ~m_present[:, 1:]
+    pdb[nodes, :, 0] = _compact(m_starts, begins, k)
+    pdb[nodes, :, 1] = _compact(m_ends, finishes, k)
+
+
+def _compact(values, selected, width=None):
+    """ Moves the selected values of each row to the front (in order). Rows are filled up with nans (up to width) """
+    result = np.full((values.shape[0], width or values.shape[1]), np.nan)
+    positions = np.cumsum(selected, axis=1) - 1
+    rows, columns = np.nonzero(selected)
+    result[rows, positions[rows, columns]] = values[rows, columns]
+    return result
+
+
+def dfs(start, stop, tv_interval, _graph, _n_pdb, _deadline=None, _stats=None, _limits=None):
+    """ Depth First Search of the Graph. Returns the paths and their weights """
+    paths, weights = [], []
+    limits = _get_limits(_graph, _limits)
+    _dfs_inner(
+        [start], 0, np.zeros(len(limits[2]), dtype=np.int64), stop, tv_interval, _graph, _n_pdb,
+        _deadline or Deadline(), _stats or SearchStats(), limits, paths, weights
+    )
+    return paths, weights
+
+
+def _dfs_inner(path, weight, counts, stop, tv, _graph, _n_pdb, _deadline, _stats, limits, paths, weights):
+    """
+    Recursive inner method. The path is shared (used as a stack) and only copied
+    (into paths, with its weight into weights) once stop is reached. The frontier is the depth of the stack.
+    counts are the limited counts of the path (see _get_limits)
+    """
+    if path[-1] == stop:
+        paths.append(list(path))
+        weights.append(weight)
+        return
+
+    if _deadline.check():
+        return
+
+    lo, hi = _graph.out_offsets[path[-1]], _graph.out_offsets[path[-1] + 1]
+    targets = _graph.out_targets[lo:hi]
+    achieved_tvs = weight + _graph.out_weights[lo:hi]
+    achieved_counts = counts + limits[0][lo:hi]
+    val_fs = _func_dist_vec(_n_pdb[targets], tv, achieved_tvs)
+    if len(counts) != 0:
+        val_fs &= _within_limits(achieved_counts, limits[1][targets], limits[2])
+
+    valid_targets = targets[val_fs].tolist()
+    _stats.expand(len(valid_targets), len(targets) - len(valid_targets))
+    for target, t_weight, t_counts in zip(valid_targets, achieved_tvs[val_fs].tolist(), achieved_counts[val_fs]):
+        path.append(target)
+        _stats.push(1)
+        _dfs_inner(path, t_weight, t_counts, stop, tv, _graph, _n_pdb, _deadline, _stats, limits, paths, weights)
+        _stats.pop(1)
+        path.pop()
+
+
+def bfs_filo(start, stop, tv_interval, _graph, _n_pdb, _deadline=None, _stats=None, _limits=None):
+    """ Breadth-First-Search using a FILO approach. """
+    return _bfs(
+        start, stop, tv_interval, _graph, _n_pdb, _deadline or Deadline(), _stats or SearchStats(),
+        _get_limits(_graph, _limits), fifo=False
+    )
 
 
-def bfs_fifo(start, stop, tv_interval, _graph, _n_pdb):
+def bfs_fifo(start, stop, tv_interval, _graph, _n_pdb, _deadline=None, _stats=None, _limits=None):
     """ Breadth-First-Search using a FIFO approach. (classic approach) """
-    queue = deque()
-    queue.append([start.index, [], 0])
-    paths = []
+    return _bfs(
+        start, stop, tv_interval, _graph, _n_pdb, _deadline or Deadline(), _stats or SearchStats(),
+        _get_limits(_graph, _limits), fifo=True
+    )
 
-    while queue:
-        cur_node, how_to_get, sum_weight = queue.popleft()
 
-        if cur_node == stop.index:
-            paths.append([*how_to_get, cur_node])
-            continue
+def _bfs(start, stop, tv_interval, _graph, _n_pdb, _deadline, _stats, limits, fifo=True):
+    """
+    Breadth-First-Search. Depending on fifo, the queue is either used as FIFO or as FILO.
+    The queue only holds the entries of the paths in the path table (and their limited counts, see _get_limits).
+    Returns the paths and their weights
+    """
+    table = _PathTable()
+    queue = deque()
+    queue.append([start, table.add(-1, start)[0], 0, np.zeros(len(limits[2]), dtype=np.int64)])
+    _stats.push(1)
+    end_ids, end_weights = [], []
 
-        edges = _graph.es.select(_source=cur_node)
-        eids = [e.index for e in edges]
+    while queue and not _deadline.check():
+        cur_node, cur_id, sum_weight, counts = queue.popleft() if fifo else queue.pop()
+        _stats.pop(1)
 
-        targeted_nodes = [e.target for e in edges]
-        achieved_tvs = [_graph.es[e]["mono_weight"] + sum_weight for e in eids]
-        val_fs = [
-            _func_dist(_n_pdb[out_edge.target, :], tv_interval - g_pre)
-            for out_edge, g_pre in zip(edges, achieved_tvs)
-        ]
+        if cur_node == stop:
+            end_ids.append(cur_id)
+            end_weights.append(sum_weight)
+            continue
 
-        pruned_targeted_nodes = [tn for tn, val_f in zip(targeted_nodes, val_fs) if val_f]
-        pruned_achieved_tvs = [tv for tv, val_f in zip(achieved_tvs, val_fs) if val_f]
+        lo, hi = _graph.out_offsets[cur_node], _graph.out_offsets[cur_node + 1]
+        targets = _graph.out_targets[lo:hi]
+        achieved_tvs = sum_weight + _graph.out_weights[lo:hi]
+        achieved_counts = counts + limits[0][lo:hi]
+        val_fs = _func_dist_vec(_n_pdb[targets], tv_interval, achieved_tvs)
+        if len(counts) != 0:
+            val_fs &= _within_limits(achieved_counts, limits[1][targets], limits[2])
 
-        for x, y in zip(pruned_targeted_nodes, pruned_achieved_tvs):
-            queue.append([x, how_to_get + [cur_node], y])
+        valid_targets = targets[val_fs]
+        valid_ids = table.add(cur_id, valid_targets)
+        for x, i, y, c in zip(
+            valid_targets.tolist(), valid_ids.tolist(), achieved_tvs[val_fs].tolist(), achieved_counts[val_fs]
+        ):
+            queue.append([x, i, y, c])
+        _stats.expand(len(valid_targets), len(targets) - len(valid_targets))
+        _stats.push(len(valid_targets))
 
-    return paths
+    return table.paths(end_ids), end_weights
 
 
-def top_sort_query(start, stop, tv_interval, _graph, _n_pdb):
+def top_sort_query(start, stop, tv_interval, _graph, _n_pdb, _deadline=None, _stats=None, _limits=None):
     """ Retrieve paths using the top. sorted nodes """
-    # retrieve top sort first
-    # TODO we need to load this from file? Or is it quick enough?
-    _top_sort = _graph.topological_sorting()
+    # The top. sort is precomputed in the compact graph
+    return _top_sort_traversal(
+        _graph.top_sort.tolist(), tv_interval, _graph, _n_pdb, _deadline or Deadline(), _stats or SearchStats(),
+        _limits=_limits
+    )
 
-    dd = defaultdict(lambda: [[], []])
 
-    dd[_top_sort[0]][0] = [0]
-    dd[_top_sort[0]][1] = [[_top_sort[0]]]
-    for n in _top_sort[0:-1]:
+def top_sort_attrs_query(start, stop, tv_interval, _graph, _n_pdb, _deadline=None, _stats=None, _limits=None):
+    """ Retrieve paths using the top. sorted nodes """
+    # retrieve top sort first (loaded from file, see get_top_sort_path)
+    # This is the fastest imple right now!
+    return _top_sort_traversal(
+        _get_top_sort_attrs(_graph), tv_interval, _graph, _n_pdb, _deadline or Deadline(), _stats or SearchStats(),
+        _limits=_limits
+    )
+
+
+def top_sort_attrs_query_limit_variants(
+    start, stop, tv_interval, _graph, _n_pdb, _limit_variants=1, _deadline=None, _stats=None, _limits=None
+):
+    """ Retrieve paths using the top. sorted nodes, with up to _limit_variants variants (unless set in _limits) """
+    # retrieve top sort first (loaded from file, see get_top_sort_path)
+    # Paths are pruned as soon as they cannot reach the end within the limit (see _get_limits)
+    _limits = dict(_limits or dict())
+    if _limits.get("variants") is None:
+        _limits["variants"] = _limit_variants
+    return _top_sort_traversal(
+        _get_top_sort_attrs(_graph), tv_interval, _graph, _n_pdb, _deadline or Deadline(), _stats or SearchStats(),
+        _limits=_limits
+    )
+
+
+def top_sort_attrs_multi_query(
+    start, stop, tv_intervals, _graph, _n_pdb, _deadline=None, _stats=None, _limits=None
+):
+    """
+    Retrieve paths for multiple target intervals (tv_intervals, shape: m x 2) at once, using the top. sorted nodes.
+    A path is expanded as long as any of the target intervals is still reachable.
+    Returns the paths and their weights.
+    """
+    # Merge the target intervals, so that we can check all at once
+    merged = np.array(_merge_overlapping_intervals(sorted(np.asarray(tv_intervals).tolist())))
+    return _top_sort_traversal(
+        _get_top_sort_attrs(_graph), (merged[:, 0], merged[:, 1]), _graph, _n_pdb, _deadline or Deadline(),
+        _stats or SearchStats(), _limits=_limits, _dist=_func_dist_multi_vec
+    )
 
-        edges = _graph.es.select(_source=n)
-        eids = [e.index for e in edges]
-        expand_tvs = [_graph.es[e]["mono_weight"] for e in eids]
-        achieved_tvs = [[p_tv + e_tv for e_tv in expand_tvs] for p_tv in dd[n][0]]
 
-        # check if we expand
-        val_fs = [
-            [_func_dist(_n_pdb[out_edge.target, :], tv_interval - e_tv) for out_edge, e_tv in zip(edges, a_tvs)]
-            for a_tvs in achieved_tvs
-        ]
+def count_query(start, stop, tv_interval, _graph, _n_pdb, _deadline=None, _stats=None, _limits=None):
+    """
+    Count the paths from start to stop matching tv_interval, without materializing them.
+    Dynamic programming over the top. sorted nodes: each node keeps the reached weights (with the limited counts,
+    see _get_limits) and the number of paths reaching it with each of them (pruned via the pdb and the limits).
+    Returns the number of paths.
+    The counters (_stats) count the (distinct) weights per node instead of the partial paths.
+    """
+    _deadline = _deadline or Deadline()
+    _stats = _stats or SearchStats()
+    edge_counts, min_counts, limits = _get_limits(_graph, _limits)
 
-        # get all with val_f == true and compact them in our queue
-        for p, v_fs, a_tvs in zip(dd[n][1], val_fs, achieved_tvs):
-            for e, fs, cur_tv in zip(edges, v_fs, a_tvs):
-                if fs:
-                    dd[e.target][0].append(cur_tv)
-                    dd[e.target][1].append([*p, e.target])
+    # dd[node] holds the reached weights and limited counts (as rows: weight, counts...) and the number of paths
+    dd = defaultdict(lambda: [[], []])
+    dd[start][0] = [np.zeros((1, 1 + len(limits)), dtype=np.int64)]
+    dd[start][1] = [np.ones(1, dtype=np.int64)]
+    _stats.push(1)
+    for n in _graph.top_sort.tolist():
+        if n == stop or _deadline.check():
+            break
 
         # save memory
-        del dd[n]
+        n_rows, n_counts = dd.pop(n, ([], []))
+        _stats.pop(sum(len(x) for x in n_rows))
+        lo, hi = _graph.out_offsets[n], _graph.out_offsets[n + 1]
+        if len(n_rows) == 0 or lo == hi:
+            continue
 
-    return dd[_top_sort[-1]][1]
+        # Compact the weights (summing up the number of paths with the same weight and counts)
+        n_rows, inverse = np.unique(np.concatenate(n_rows), axis=0, return_inverse=True)
+        counts = np.zeros(len(n_rows), dtype=np.int64)
+        np.add.at(counts, inverse.reshape(-1), np.concatenate(n_counts))
 
+        targets = _graph.out_targets[lo:hi]
+        achieved_tvs = n_rows[:, 0, None] + _graph.out_weights[lo:hi][None, :]
+        achieved_counts = n_rows[:, None, 1:] + edge_counts[lo:hi][None]
+        val_fs = _func_dist_vec(_n_pdb[targets], tv_interval, achieved_tvs)
+        if len(limits) != 0:
+            val_fs &= _within_limits(achieved_counts, min_counts[targets][None], limits)
+        expanded = int(val_fs.sum())
+        _stats.expand(expanded, val_fs.size - expanded)
+        _stats.push(expanded)
 
-def top_sort_attrs_query(start, stop, tv_interval, _graph, _n_pdb):
-    """ Retrieve paths using the top. sorted nodes """
-    # retrieve top sort first
-    # TODO we need to load this from file? Or is it quick enough?
-    # This is the fastest imple right now!
+        for idx, t in enumerate(targets.tolist()):
+            fs = val_fs[:, idx]
+            if fs.any():
+                dd[t][0].append(np.column_stack([achieved_tvs[fs, idx], achieved_counts[fs, idx]]))
+                dd[t][1].append(counts[fs])
 
-    sorted_by_position_attr = []
-    s = set([x for x, y in zip(range(_graph.vcount()), _graph.vs.indegree()) if y == 0])
-    marked_edges = [False]*_graph.ecount()
-
-    while len(s) != 0:
-        t = []  # (isoform_name, iso_pos, pos, n)
-        for x in s:
-            node_attrs = _graph.vs[x].attributes()
-
-            if "isoform_accession" in node_attrs:
-                t1 = node_attrs["isoform_accession"] if node_attrs["isoform_accession"] else node_attrs["accession"]
-            else:
-                t1 = node_attrs["accession"]
-
-            if "isoform_position" in node_attrs:
-                t2 = node_attrs["isoform_position"] if node_attrs["isoform_position"] else float("-inf")
-            else:
-                t2 = float("-inf")
-
-            t3 = node_attrs["position"] if node_attrs["position"] else float("-inf")
-            t.append((t1, t2, t3, x))
-        # sorted up down down
-        res = sorted(t, key=lambda x: (-len(x[0]), [-ord(c) for c in x[0]], x[1], x[2]))
-        n = res[0][3]
-        s.remove(n)
-
-        sorted_by_position_attr.append(n)
-        for e_out in _graph.vs[n].out_edges():
-            marked_edges[e_out.index] = True
-            in_out_edges = [x.index for x in _graph.vs[e_out.target].in_edges()]
-            if all([marked_edges[x] for x in in_out_edges]):
-                s.add(e_out.target)
+    # All weights reaching stop are matching (pdb of stop is [0, 0])
+    return int(sum(c.sum() for c in dd[stop][1]))
 
-    _top_sort = sorted_by_position_attr
 
-    dd = defaultdict(lambda: [[], []])
-
-    dd[_top_sort[0]][0] = [0]
-    dd[_top_sort[0]][1] = [[_top_sort[0]]]
-    for n in _top_sort[0:-1]:
+def bidirectional_query(start, stop, tv_interval, _graph, _n_pdb, _deadline=None, _stats=None, _limits=None):
+    """
+    Meet-in-the-middle search, which splits the top. sort in two halves. Prefixes are expanded from start
+    over the first half (pruned via the pdb) and suffixes from stop over the second half (backwards, pruned
+    via the forward pdb). Prefixes crossing into the second half are joined with the suffixes of the crossed
+    node via their sorted weights (and checked against the limits, see _get_limits).
+    Returns the paths and their weights.
+    """
+    _deadline = _deadline or Deadline()
+    _stats = _stats or SearchStats()
+    top_sort = _graph.top_sort.tolist()
+    f_pdb = _get_forward_pdb(_graph, _n_pdb)
+    in_offsets, in_sources, in_weights = _get_in_edges(_graph)
+    edge_counts, min_counts, limits = _get_limits(_graph, _limits)
+    f_min_counts = _get_limits(_graph, _limits, forward=True)[1]
+    in_counts = edge_counts[np.argsort(_graph.out_targets, kind="stable")]  # In the order of the in-edges
+
+    # The meeting layer: nodes with rank >= middle are in the second half
+    middle = max(1, min(len(top_sort) // 2, len(top_sort) - 1))
+    rank = np.empty(_graph.vcount, dtype=np.int64)
+    rank[_graph.top_sort] = np.arange(len(top_sort))
+
+    # Expand the prefixes (forward) over the first half
+    prefixes = _PathTable()
+    dd = defaultdict(lambda: [[], [], []])
+    dd[start] = [[np.zeros(1, dtype=np.int64)], [prefixes.add(-1, start)], [np.zeros((1, len(limits)), dtype=np.int64)]]
+    _stats.push(1)
+    crossing = defaultdict(lambda: [[], [], []])  # node in second half -> prefixes (incl. the crossing edge)
+    for n in top_sort[:middle]:
+        if _deadline.check():
+            break
+        n_tvs, n_ids, n_counts = dd.pop(n, ([], [], []))
+        _stats.pop(sum(len(x) for x in n_ids))
+        lo, hi = _graph.out_offsets[n], _graph.out_offsets[n + 1]
+        if len(n_ids) == 0 or lo == hi:
+            continue
+        n_tvs, n_ids, n_counts = np.concatenate(n_tvs), np.concatenate(n_ids), np.concatenate(n_counts)
+
+        targets = _graph.out_targets[lo:hi]
+        achieved_tvs = n_tvs[:, None] + _graph.out_weights[lo:hi][None, :]
+        achieved_counts = n_counts[:, None] + edge_counts[lo:hi][None]
+        val_fs = _func_dist_vec(_n_pdb[targets], tv_interval, achieved_tvs)
+        if len(limits) != 0:
+            val_fs &= _within_limits(achieved_counts, min_counts[targets][None], limits)
+        expanded = int(val_fs.sum())
+        _stats.expand(expanded, val_fs.size - expanded)
+        _stats.push(expanded)
+        for idx, t in enumerate(targets.tolist()):
+            fs = val_fs[:, idx]
+            if fs.any():
+                if rank[t] < middle:
+                    dd[t][0].append(achieved_tvs[fs, idx])
+                    dd[t][1].append(prefixes.add(n_ids[fs], t))
+                    dd[t][2].append(achieved_counts[fs, idx])
+                else:
+                    crossing[t][0].append(achieved_tvs[fs, idx])
+                    crossing[t][1].append(n_ids[fs])
+                    crossing[t][2].append(achieved_counts[fs, idx])
+
+    # Expand the suffixes (backwards) over the second half and join them with the crossing prefixes
+    suffixes = _PathTable()
+    dd = defaultdict(lambda: [[], [], []])
+    dd[stop] = [[np.zeros(1, dtype=np.int64)], [suffixes.add(-1, stop)], [np.zeros((1, len(limits)), dtype=np.int64)]]
+    _stats.push(1)
+    joined_prefixes, joined_suffixes, joined_tvs = [], [], []
+    for n in top_sort[:middle - 1:-1]:
+        if _deadline.check():
+            break
+        n_tvs, n_ids, n_counts = dd.pop(n, ([], [], []))
+        _stats.pop(sum(len(x) for x in n_ids))
+        c_tvs, c_ids, c_counts = crossing.pop(n, ([], [], []))
+        _stats.pop(sum(len(x) for x in c_ids))
+        if len(n_ids) == 0:
+            continue
+        n_tvs, n_ids, n_counts = np.concatenate(n_tvs), np.concatenate(n_ids), np.concatenate(n_counts)
+
+        # Join via the sorted weights of the suffixes
+        if len(c_ids) != 0:
+            c_tvs, c_ids, c_counts = np.concatenate(c_tvs), np.concatenate(c_ids), np.concatenate(c_counts)
+            order = np.argsort(n_tvs, kind="stable")
+            sorted_tvs = n_tvs[order]
+            lefts = np.searchsorted(sorted_tvs, tv_interval[0] - c_tvs, side="left")
+            rights = np.searchsorted(sorted_tvs, tv_interval[1] - c_tvs, side="right")
+            counts = np.maximum(rights - lefts, 0)
+            pairs = np.repeat(np.arange(len(c_ids)), counts)
+            # The positions lefts[i]:rights[i] in the sorted weights for each (repeated) prefix
+            positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            matches = order[np.repeat(lefts, counts) + positions]
+            if len(limits) != 0:
+                within = np.all(c_counts[pairs] + n_counts[matches] <= limits, axis=-1)
+                pairs, matches = pairs[within], matches[within]
+            joined_prefixes.append(c_ids[pairs])
+            joined_suffixes.append(n_ids[matches])
+            joined_tvs.append(c_tvs[pairs] + n_tvs[matches])
+
+        # Expand to the predecessors in the second half
+        lo, hi = in_offsets[n], in_offsets[n + 1]
+        sources = in_sources[lo:hi]
+        keep = rank[sources] >= middle
+        sources = sources[keep]
+        if len(sources) == 0:
+            continue
+        achieved_tvs = n_tvs[:, None] + in_weights[lo:hi][keep][None, :]
+        achieved_counts = n_counts[:, None] + in_counts[lo:hi][keep][None]
+        val_fs = _func_dist_vec(f_pdb[sources], tv_interval, achieved_tvs)
+        if len(limits) != 0:
+            val_fs &= _within_limits(achieved_counts, f_min_counts[sources][None], limits)
+        expanded = int(val_fs.sum())
+        _stats.expand(expanded, val_fs.size - expanded)
+        _stats.push(expanded)
+        for idx, s in enumerate(sources.tolist()):
+            fs = val_fs[:, idx]
+            if fs.any():
+                dd[s][0].append(achieved_tvs[fs, idx])
+                dd[s][1].append(suffixes.add(n_ids[fs], s))
+                dd[s][2].append(achieved_counts[fs, idx])
+
+    if len(joined_tvs) == 0:
+        return [], []
+
+    # Reconstruct the paths (the suffixes are stored from stop to the crossed node)
+    paths = [
+        p + s[::-1] for p, s in zip(
+            prefixes.paths(np.concatenate(joined_prefixes).tolist()),
+            suffixes.paths(np.concatenate(joined_suffixes).tolist())
+        )
+    ]
+    return paths, np.concatenate(joined_tvs).tolist()
+
+
+def _get_forward_pdb(_graph, _n_pdb):
+    """
+    Returns the forward pdb (as matrix, with the k of _n_pdb) of the graph (and builds it, if not already present).
+    If _n_pdb is an exact index, the forward exact index (of the same resolution) is returned.
+    """
+    if not isinstance(_n_pdb, np.ndarray):
+        key = ("exact", _n_pdb.resolution)
+        if key not in _graph.forward_pdbs:
+            _graph.forward_pdbs[key] = _n_pdb.build_forward(_graph)
+        return _graph.forward_pdbs[key]
 
-        edges = _graph.es.select(_source=n)
-        eids = [e.index for e in edges]
-        expand_tvs = [_graph.es[e]["mono_weight"] for e in eids]
-        achieved_tvs = [[p_tv + e_tv for e_tv in expand_tvs] for p_tv in dd[n][0]]
+    k = _n_pdb.shape[1]
+    if k not in _graph.forward_pdbs:
+        _graph.forward_pdbs[k] = build_forward_pdb(_graph, k=k)
+    return _graph.forward_pdbs[k]
 
-        # check if we expand
-        val_fs = [
-            [_func_dist(_n_pdb[out_edge.target, :], tv_interval - e_tv) for out_edge, e_tv in zip(edges, a_tvs)]
-            for a_tvs in achieved_tvs
-        ]
 
-        # get all with val_f == true and compact them in our queue
-        for p, v_fs, a_tvs in zip(dd[n][1], val_fs, achieved_tvs):
-            for e, fs, cur_tv in zip(edges, v_fs, a_tvs):
-                if fs:
-                    dd[e.target][0].append(cur_tv)
-                    dd[e.target][1].append([*p, e.target])
+def _get_top_sort_attrs(_graph):
+    """ Returns the attribute ordered top. sort of the graph (and builds it, if not already present) """
+    if _graph.attrs_top_sort is None:
+        _graph.attrs_top_sort = np.array(build_top_sort_attrs(_graph), dtype=np.int64)
+    return _graph.attrs_top_sort.tolist()
 
-        # save memory
-        del dd[n]
 
-    return dd[_top_sort[-1]][1]
+def build_top_sort_attrs(_graph):
+    """
+    Topological sort, preferring nodes by their (isoform) accession and (isoform) positions.
+    The nodes which can be visited next are kept in a heap, so this takes O(n log n).
+    """
+    # Precompute the sort keys (isoform_name, iso_pos, pos) of each node (sorted up down down)
+    acc_keys = dict()
+    keys = []
+    for iso_acc, acc, iso_pos, pos in zip(
+        _graph.isoform_accession, _graph.accession, _graph.isoform_position.tolist(), _graph.position.tolist()
+    ):
+        t1 = iso_acc if iso_acc else acc
+        if t1 not in acc_keys:
+            acc_keys[t1] = (-len(t1), [-ord(c) for c in t1])
+        keys.append((*acc_keys[t1], iso_pos, pos))
 
+    sorted_by_position_attr = []
+    out_offsets = _graph.out_offsets.tolist()
+    out_targets = _graph.out_targets.tolist()
+    in_degree = _graph.in_degree.tolist()
+    heap = [(keys[x], x) for x, y in enumerate(in_degree) if y == 0]
+    heapq.heapify(heap)
 
+    while len(heap) != 0:
+        _, n = heapq.heappop(heap)
 
-def top_sort_attrs_query_limit_variants(start, stop, tv_interval, _graph, _n_pdb, _limit_variants=1):
-    """ Retrieve paths using the top. sorted nodes """
-    # retrieve top sort first
-    # TODO we need to load this from file? Or is it quick enough?
-    # This implementation is slower but "SHOULD" reduce the searcch space of p53 considerable!
-    # However, the search do take roughly the same amount of time.... (# TODO ...)
+        sorted_by_position_attr.append(n)
+        for target in out_targets[out_offsets[n]:out_offsets[n + 1]]:
+            in_degree[target] -= 1
+            if in_degree[target] == 0:
+                heapq.heappush(heap, (keys[target], target))
 
-    sorted_by_position_attr = []
-    s = set([x for x, y in zip(range(_graph.vcount()), _graph.vs.indegree()) if y == 0])
-    marked_edges = [False]*_graph.ecount()
-
-    while len(s) != 0:
-        t = []  # (isoform_name, iso_pos, pos, n)
-        for x in s:
-            node_attrs = _graph.vs[x].attributes()
-
-            if "isoform_accession" in node_attrs:
-                t1 = node_attrs["isoform_accession"] if node_attrs["isoform_accession"] else node_attrs["accession"]
-            else:
-                t1 = node_attrs["accession"]
-
-            if "isoform_position" in node_attrs:
-                t2 = node_attrs["isoform_position"] if node_attrs["isoform_position"] else float("-inf")
-            else:
-                t2 = float("-inf")
-
-            t3 = node_attrs["position"] if node_attrs["position"] else float("-inf")
-            t.append((t1, t2, t3, x))
-        # sorted up down down
-        res = sorted(t, key=lambda x: (-len(x[0]), [-ord(c) for c in x[0]], x[1], x[2]))
-        n = res[0][3]
-        s.remove(n)
+    return sorted_by_position_attr
 
-        sorted_by_position_attr.append(n)
-        for e_out in _graph.vs[n].out_edges():
-            marked_edges[e_out.index] = True
-            in_out_edges = [x.index for x in _graph.vs[e_out.target].in_edges()]
-            if all([marked_edges[x] for x in in_out_edges]):
-                s.add(e_out.target)
 
-    _top_sort = sorted_by_position_attr
+def _top_sort_traversal(
+    _top_sort, tv_interval, _graph, _n_pdb, _deadline, _stats, _limits=None, _dist=None
+):
+    """
+    Traverse the nodes in the order of the top. sort and expand all paths at once.
+    If _limits are set (e.g. dict(variants=1)), only paths, which can still reach the end within them, are expanded.
+    If the deadline passes, the paths which already reached the last node are returned.
 
-    # Generate np_array containing num of variants
+    _dist decides if paths are expanded (default: _func_dist_vec). Returns the paths and their weights.
 
-    var_counts = np.zeros((_graph.ecount(),), dtype=int)
-    for e in _graph.es:
-        var_counts[e.index] = _resolve_or(e["qualifiers"], "VARIANT", min)
+    The paths are kept as entries in a path table, so dd[node] only holds arrays of
+    weights, path entries and the limited counts (dd[key][2], shape: paths x limits).
+    """
+    _dist = _dist or _func_dist_vec
+    table = _PathTable()
+    edge_counts, min_counts, limits = _get_limits(_graph, _limits)
 
     dd = defaultdict(lambda: [[], [], []])
-    # param dd[key][2] yields number of variants
-
-    dd[_top_sort[0]][0] = [0]
-    dd[_top_sort[0]][1] = [[_top_sort[0]]]
-    dd[_top_sort[0]][2] = [0]  # Number of variants is 0 at beginning
+    dd[_top_sort[0]][0] = [np.zeros(1, dtype=np.int64)]
+    dd[_top_sort[0]][1] = [table.add(-1, _top_sort[0])]
+    dd[_top_sort[0]][2] = [np.zeros((1, len(limits)), dtype=np.int64)]  # The counts are 0 at beginning
+    _stats.push(1)
     for n in _top_sort[0:-1]:
+        if _deadline.check():
+            break
 
-        edges = _graph.es.select(_source=n)
-        eids = [e.index for e in edges]
-        e_qualifiers = var_counts[eids]
-        expand_tvs = [_graph.es[e]["mono_weight"] for e in eids]
-        achieved_tvs = [[p_tv + e_tv for e_tv in expand_tvs] for p_tv in dd[n][0]]
-        acieved_e_qualiefiers = [[var_count + e_q for e_q in e_qualifiers] for var_count in dd[n][2]]
-
-        # check if we expand
-        val_fs = [
-            [
-                # Check for distance
-                _func_dist(_n_pdb[out_edge.target, :], tv_interval - e_tv) and
-                # Check for variants
-                var_count <= _limit_variants
-                for out_edge, e_tv, var_count in zip(edges, a_tvs, a_e_vars)
-            ]
-            for a_tvs, a_e_vars in zip(achieved_tvs, acieved_e_qualiefiers)
-        ]
-
-        # get all with val_f == true and compact them in our queue
-        for p, v_fs, a_tvs, a_e_vars in zip(dd[n][1], val_fs, achieved_tvs, acieved_e_qualiefiers):
-            for e, fs, cur_tv, var_count in zip(edges, v_fs, a_tvs, a_e_vars):
-                if fs:
-                    dd[e.target][0].append(cur_tv)
-                    dd[e.target][1].append([*p, e.target])
-                    dd[e.target][2].append(var_count)
-                    if var_count == _limit_variants:
-                        pass
+        # save memory
+        n_tvs, n_ids, n_counts = dd.pop(n, ([], [], []))
+        _stats.pop(sum(len(x) for x in n_ids))
+        lo, hi = _graph.out_offsets[n], _graph.out_offsets[n + 1]
+        if len(n_ids) == 0 or lo == hi:
+            continue
+        n_tvs, n_ids, n_counts = np.concatenate(n_tvs), np.concatenate(n_ids), np.concatenate(n_counts)
 
+        targets = _graph.out_targets[lo:hi]
+        pdbs = _n_pdb[targets]
+        expand_tvs = _graph.out_weights[lo:hi]
+        e_counts = edge_counts[lo:hi]
+        t_min_counts = min_counts[targets]
 
-        # save memory
-        del dd[n]
+        # Group the out-edges by target (in case of multiple edges to the same node)
+        target_columns = defaultdict(list)
+        for idx, t in enumerate(targets.tolist()):
+            target_columns[t].append(idx)
+
+        for c in range(0, len(n_ids), _CHUNK_SIZE):
+            if _deadline.check():
+                break
+
+            achieved_tvs = n_tvs[c:c + _CHUNK_SIZE, None] + expand_tvs[None, :]
+            achieved_counts = n_counts[c:c + _CHUNK_SIZE, None] + e_counts[None, :]
+
+            # check if we expand (distance and limits)
+            val_fs = _dist(pdbs, tv_interval, achieved_tvs)
+            if len(limits) != 0:
+                val_fs &= _within_limits(achieved_counts, t_min_counts[None, :], limits)
+            expanded = int(val_fs.sum())
+            _stats.expand(expanded, val_fs.size - expanded)
+            _stats.push(expanded)
+
+            # get all with val_f == true and add them (in order of the paths) to the targets
+            c_ids = n_ids[c:c + _CHUNK_SIZE]
+            for t, columns in target_columns.items():
+                t_fs = val_fs[:, columns]
+                rows, _ = np.nonzero(t_fs)
+                if len(rows) != 0:
+                    dd[t][0].append(achieved_tvs[:, columns][t_fs])
+                    dd[t][1].append(table.add(c_ids[rows], t))
+                    dd[t][2].append(achieved_counts[:, columns][t_fs])
+
+    # Reconstruct the paths, which reached the last node
+    last_tvs, last_ids, _ = dd[_top_sort[-1]]
+    if len(last_ids) == 0:
+        return [], []
+    return table.paths(np.concatenate(last_ids).tolist()), np.concatenate(last_tvs).tolist()
 
-    return dd[_top_sort[-1]][1]
 
 def _resolve_or(fts, feature_type, or_count):
+    return _count_features(fts, lambda x: x == feature_type, or_count)
+
+
+def _count_features(fts, is_counted, or_count):
+    """ Counts the qualifiers, whose type is_counted. The counts of the alternatives (Or) are resolved via or_count """
     if fts is None:
         return 0
     count = 0
     for ft in fts:
         if isinstance(ft, Or):
-            t = [_resolve_or(or_ft, feature_type, or_count) for or_ft in ft]
+            t = [_count_features(or_ft, is_counted, or_count) for or_ft in ft]
             count += or_count(t)
         else:
-            if ft.type == feature_type:
+            if is_counted(ft.type):
                 count += 1
 
     return count
 
+
+def _func_dist_vec(pdbs, tv_interval, achieved_tvs):
+    """
+    Vectorized version of _func_dist. pdbs contains the intervals of d target nodes (shape: d x k x 2).
+    Checks for each target i, if the interval tv_interval - achieved_tvs[..., i] is overlapping in pdbs[i].
+    """
+    if not isinstance(pdbs, np.ndarray):
+        # The intervals of an exact index (see exact_index.py)
+        return pdbs.overlaps(tv_interval[0] - achieved_tvs, tv_interval[1] - achieved_tvs)
+
+    lows = tv_interval[0] - achieved_tvs
+    highs = tv_interval[1] - achieved_tvs
+    # Same as searchsorted on each row (nans are at the end and never smaller)
+    lower_index = np.sum(pdbs[:, :, 1] < lows[..., None], axis=-1)
+    upper_index = np.sum(pdbs[:, :, 0] < highs[..., None], axis=-1)
+
+    # Also check for edge case on the right side of queried s_interval
+    k = pdbs.shape[1]
+    edge_starts = pdbs[np.arange(pdbs.shape[0]), np.minimum(lower_index, k - 1), 0]
+    return (upper_index > lower_index) | (
+        (lower_index != k) & (lower_index == upper_index) & (edge_starts == highs)
+    )
+
+
+def _func_dist_multi_vec(pdbs, tv_intervals, achieved_tvs):
+    """
+    Like _func_dist_vec, but for multiple (merged, disjoint and sorted) target intervals tv_intervals=(starts, ends).
+    Checks for each target i, if any interval of pdbs[i] + achieved_tvs[..., i] overlaps any of the target intervals.
+    """
+    starts, ends = tv_intervals
+    lows = pdbs[:, :, 0] + achieved_tvs[..., None]
+    highs = pdbs[:, :, 1] + achieved_tvs[..., None]
+
+    # The first target interval ending at or after lows (nans are never matching)
+    index = np.searchsorted(ends, lows)
+    overlapping = (index < len(ends)) & (starts[np.minimum(index, len(ends) - 1)] <= highs)
+    return np.any(overlapping, axis=-1)
+
+
 def _func_dist(pdb, s_interval):
     """ function to decide wheather an interval is overlapping or not in pdb. """
     lower_index = np.searchsorted(pdb[:,1], s_interval[0])
@@ -0,0 +1,184 @@
+import bisect
+import inspect
+import threading
+import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import falcon
+
+from cache_utils import GRAPH_CACHE, METADATA_CACHE, RESULT_CACHE
+
+# The buckets (upper bounds in seconds) of the histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# The caches, whose stats are exported
+CACHES = dict(graph=GRAPH_CACHE, metadata=METADATA_CACHE, result=RESULT_CACHE)
+
+# The timer of the request, which is currently handled by this thread
+_CURRENT = threading.local()
+
+
+class RequestTimer(object):
+    """ Accumulates the time spent in each phase (e.g. graph_load, traversal, ...) of a request """
+
+    def __init__(self):
+        self.start = timeit.default_timer()
+        self.phases = OrderedDict()  # phase -> seconds (in order of their first occurrence)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return timeit.default_timer() - self.start
+
+
+@contextmanager
+def phase(name):
+    """
+    Times a phase of the current request (phases may be nested, e.g. top_sort in graph_load).
+    Nothing is recorded outside of a request (e.g. in worker processes or the precompute command).
+    """
+    timer = getattr(_CURRENT, "timer", None)
+    if timer is None:
+        yield
+        return
+    starttime = timeit.default_timer()
+    try:
+        yield
+    finally:
+        timer.add(name, timeit.default_timer() - starttime)
+
+
+class Histogram(object):
+    """ Thread-safe histogram (per combination of label values), which is exported in the Prometheus format """
+
+    def __init__(self, name, description, labels, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._values = dict()  # label values -> [counts per bucket (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.setdefault(label_values, [[0]*(len(self.buckets) + 1), 0.0])
+            entry[0][idx] += 1
+            entry[1] += value
+
+    def expose(self):
+        """ Returns the lines of this histogram in the Prometheus text format """
+        lines = [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} histogram".format(self.name)
+        ]
+        with self._lock:
+            values = sorted((x, (list(y[0]), y[1])) for x, y in self._values.items())
+        for label_values, (counts, total) in values:
+            labels = ",".join('{}="{}"'.format(x, _escape(y)) for x, y in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, labels, bound, cumulative))
+            lines.append("{}_sum{{{}}} {}".format(self.name, labels, total))
+            lines.append("{}_count{{{}}} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+def _escape(value):
+    """ Escape a label value """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+REQUEST_DURATION = Histogram(
+    "protgraphrest_request_duration_seconds", "The duration of requests (including streamed content).",
+    ["route", "method", "status"]
+)
+PHASE_DURATION = Histogram(
+    "protgraphrest_phase_duration_seconds", "The duration of the phases of requests.",
+    ["route", "phase"]
+)
+
+
+class TimingMiddleware(object):
+    """
+    Times each request and its phases. The phases (until the response is returned) are set in the Server-Timing
+    header. Streamed content is timed while it is generated, so it only appears in the histograms.
+    """
+
+    def process_request(self, req, resp):
+        _CURRENT.timer = RequestTimer()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        timer = getattr(_CURRENT, "timer", None)
+        _CURRENT.timer = None
+        if timer is None:
+            return
+
+        resp.set_header("Server-Timing", ", ".join(
+            "{};dur={:.3f}".format(name, seconds * 1000)
+            for name, seconds in [*timer.phases.items(), ("total", timer.elapsed())]
+        ))
+
+        labels = (req.uri_template or "", req.method, resp.status.split(" ", 1)[0])
+        if inspect.isgenerator(resp.stream):
+            resp.stream = self._timed_stream(resp.stream, timer, labels)
+        else:
+            self._observe(timer, labels)
+
+    def _timed_stream(self, stream, timer, labels):
+        """ Wraps a streamed response, so that its phases are recorded into the timer of the request """
+        try:
+            while True:
+                _CURRENT.timer = timer
+                try:
+                    with phase("stream"):
+                        chunk = next(stream)
+                except StopIteration:
+                    return
+                finally:
+                    _CURRENT.timer = None
+                yield chunk
+        finally:
+            stream.close()
+            self._observe(timer, labels)
+
+    @staticmethod
+    def _observe(timer, labels):
+        REQUEST_DURATION.observe(timer.elapsed(), *labels)
+        for name, seconds in timer.phases.items():
+            PHASE_DURATION.observe(seconds, labels[0], name)
+
+
+def expose_metrics():
+    """ Returns all metrics (histograms and cache stats) in the Prometheus text format """
+    lines = [*REQUEST_DURATION.expose(), *PHASE_DURATION.expose()]
+
+    stats = {name: cache.stats() for name, cache in CACHES.items()}
+    for stat, metric_type, description in [
+        ("hits", "counter", "The number of cache hits."),
+        ("misses", "counter", "The number of cache misses."),
+        ("evictions", "counter", "The number of evicted cache entries."),
+        ("expirations", "counter", "The number of expired cache entries."),
+        ("hit_rate", "gauge", "The ratio of cache hits."),
+        ("entries", "gauge", "The number of cache entries."),
+        ("bytes", "gauge", "The (estimated) size of the cache entries in bytes."),
+        ("max_bytes", "gauge", "The memory budget of the cache in bytes.")
+    ]:
+        name = "protgraphrest_cache_{}{}".format(stat, "_total" if metric_type == "counter" else "")
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for cache, cache_stats in stats.items():
+            lines.append('{}{{cache="{}"}} {}'.format(name, cache, cache_stats[stat]))
+    return "\n".join(lines) + "\n"
+
+
+class Metrics(object):
+    """ Exports the metrics in the Prometheus text format """
+
+    def on_get(self, req, resp):
+        resp.set_header("content-type", "text/plain; version=0.0.4")
+        resp.body = expose_metrics()
+        resp.status = falcon.HTTP_200